@@ -3,52 +3,649 @@
 # @Time 2020/4/3 14:55
 
 """
+import os
 import time
-import grequests
+import gzip
+import sys
+import random
 import logging
 import requests
 import json
+import codecs
+import asyncio
+import inspect
+import reprlib
+import functools
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 from urllib.error import URLError, HTTPError
 import xmltodict
 
+from ratelimit import get_bucket
+from profile.histogram import LogHistogram
+from stream_parse import iter_json_items, iter_xml_items
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 logger = logging.getLogger("test")
 
+# per call logging defaults: share of successful calls logged, max logged
+# UTF-8 bytes of request/response payloads, calls at least this slow (ms) always logged
+LOG_SAMPLE_RATE = 1.0
+LOG_MAX_BYTES = 1024
+SLOW_MS = 1000
+
+# gzip level for request bodies, 6 is zlib's default size/speed trade-off
+COMPRESS_LEVEL = 6
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+_log_repr = reprlib.Repr()
+_log_repr.maxlevel = 4
+_log_repr.maxdict = _log_repr.maxlist = _log_repr.maxtuple = 20
+_log_repr.maxstring = _log_repr.maxother = LOG_MAX_BYTES
+
+_latency = {}
+_latency_lock = threading.Lock()
+
+
+def _truncate(value, max_bytes):
+    """ Short form of a payload for logs, at most max_bytes of UTF-8, never serializes it whole """
+    if isinstance(value, bytes):
+        head, size = value[:max_bytes + 1], '%d bytes' % len(value)
+    else:
+        if not isinstance(value, str):
+            value = _log_repr.repr(value)
+        # max_bytes + 1 chars encode to more than max_bytes bytes if too long
+        head, size = value[:max_bytes + 1].encode('utf-8'), '%d chars' % len(value)
+    if len(head) <= max_bytes:
+        return head.decode('utf-8', 'replace')
+    # 'ignore' drops a character cut in half at the end
+    return '%s...(%s)' % (head[:max_bytes].decode('utf-8', 'ignore'), size)
+
+
+def record_latency(url, seconds):
+    host = urlsplit(url).netloc
+    with _latency_lock:
+        histogram = _latency.get(host)
+        if histogram is None:
+            histogram = _latency[host] = LogHistogram()
+        histogram.add(seconds)
+
+
+def latency_stats():
+    """ Latency summary (count, mean, p50, p95, p99, max in seconds) per host """
+    with _latency_lock:
+        return {host: histogram.summary() for host, histogram in _latency.items()}
+
+
+def log_api_call(url, request_data, http_status, resp_data, consume_time,
+                 sample_rate=LOG_SAMPLE_RATE, max_bytes=LOG_MAX_BYTES, slow_ms=SLOW_MS):
+    """
+    Record the call's latency and log it: failures and slow calls always,
+    successes only ``sample_rate`` of the time. The message, truncated to
+    ``max_bytes`` per payload, is only built when the level is enabled.
+    The fields are also attached as ``record.api_call`` for structured handlers.
+    """
+    record_latency(url, consume_time / 1000.0)
+    if http_status not in [200, 201]:
+        level, label = logging.ERROR, '请求API失败'
+    elif consume_time >= slow_ms:
+        level, label = logging.WARNING, '请求API慢'
+    else:
+        level, label = logging.INFO, '请求API成功'
+    if not logger.isEnabledFor(level):
+        return
+    if level == logging.INFO and sample_rate < 1 and random.random() >= sample_rate:
+        return
+    fields = {'url': url, 'status': http_status, 'consume_time': consume_time}
+    logger.log(level, '%s %s %s %s %s 耗时%s', label, url, _truncate(request_data, max_bytes),
+               http_status, _truncate(resp_data, max_bytes), consume_time,
+               extra={'api_call': fields})
+
+
+class SessionPool(object):
+    """
+    Keep-alive requests.Session per scheme://host, so calls reuse pooled
+    TCP/TLS connections instead of opening one each time.
+
+    pool_maxsize    connections kept per host
+    pool_block      True: never open more than pool_maxsize connections to a
+                    host, callers wait for a free one
+    keep_alive      False sends "Connection: close"
+
+    Has the same ``request(method, url, **kwargs)`` as the requests module,
+    so it can be passed as ``APIClient(http_service=...)``. Sessions are
+    shared by all threads; cookies are never stored, so calls stay as
+    independent as with ``requests.request``.
+    """
+    def __init__(self, pool_maxsize=20, pool_block=False, keep_alive=True):
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize,
+                              pool_block=self.pool_block, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def get_session(self, url):
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = self._sessions[host] = self._new_session()
+        return session
+
+    def request(self, method, url, **kwargs):
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
+
+
+# shared by request_api and every APIClient not given an http_service
+default_pool = SessionPool()
+
+
+class FetchResult(namedtuple('FetchResult', ['request', 'result', 'error'])):
+    """ Outcome of one fetch_many item: result, or the exception it raised """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _fetch_kwargs(request, expire_at=None):
+    """
+    fetch_many items are an uri_path or a dict of fetch_json arguments,
+    the timeout is capped to the time left before ``expire_at``
+    """
+    if isinstance(request, str):
+        kwargs = {'uri_path': request}
+    else:
+        kwargs = dict(request)
+    if expire_at is not None:
+        remaining = expire_at - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('fetch_many deadline exceeded')
+        kwargs['timeout'] = min(kwargs.get('timeout', 5), remaining)
+    return kwargs
+
+
+# threads shared by every fetch_many call in the process, a larger
+# ``concurrency`` is capped to this many calls in flight
+FETCH_MAX_WORKERS = 32
+_fetch_executor = None
+_fetch_executor_pid = None
+_fetch_executor_lock = threading.Lock()
+
+
+def _get_fetch_executor():
+    global _fetch_executor, _fetch_executor_pid
+    with _fetch_executor_lock:
+        # worker threads do not survive fork(), a child starts its own pool
+        if _fetch_executor_pid != os.getpid():
+            _fetch_executor = ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS,
+                                                 thread_name_prefix='fetch_many')
+            _fetch_executor_pid = os.getpid()
+        return _fetch_executor
+
+
+def _is_grequests(http_service):
+    # compared by name so that this module never imports grequests itself,
+    # the import gevent-patches socket and queue for the whole process
+    return getattr(http_service, '__name__', None) == 'grequests'
+
+
+def _gevent_patched():
+    """ True once gevent (e.g. through import grequests) patched the socket module """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+def _run_threads(call, requests, concurrency, expire_at):
+    """ fetch_many on the shared thread pool, (done, result, error) per item """
+    # at most ``concurrency`` items of this batch queued or running in the
+    # shared pool, the next one is submitted as one finishes
+    executor = _get_fetch_executor()
+    futures = [None] * len(requests)
+    pending = set()
+    index = 0
+    while index < len(requests) or pending:
+        timeout = None if expire_at is None else expire_at - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            break
+        while index < len(requests) and len(pending) < concurrency:
+            futures[index] = executor.submit(call, requests[index])
+            pending.add(futures[index])
+            index += 1
+        _, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+    for future in pending:
+        # drops items still queued, running ones end by their capped timeout
+        future.cancel()
+    outcomes = []
+    for future in futures:
+        if future is None or not future.done() or future.cancelled():
+            outcomes.append((False, None, None))
+        else:
+            error = future.exception()
+            outcomes.append((True, None if error is not None else future.result(), error))
+    return outcomes
+
+
+def _run_greenlets(call, requests, concurrency, expire_at):
+    """ fetch_many on greenlets, OS threads do not work on a gevent-patched socket/queue """
+    from gevent.lock import BoundedSemaphore
+    from gevent.pool import Group
+
+    semaphore = BoundedSemaphore(concurrency)
+
+    def limited(request):
+        with semaphore:
+            return call(request)
+
+    group = Group()
+    greenlets = [group.spawn(limited, request) for request in requests]
+    group.join(timeout=None if expire_at is None else max(0, expire_at - time.monotonic()))
+    outcomes = [(g.ready(), g.value, g.exception) for g in greenlets]
+    group.kill(block=False)
+    return outcomes
+
 
 def xml_to_dict(xml_str):
     data_dict = xmltodict.parse(xml_str)
     return data_dict
 
 
-def api_retry(retry_num=3, exception=Exception, raise_except=True):
+class APIError(Exception):
+    """ Non 2xx answer from an upstream, ``status_code`` says which """
+    status_code = None
+
+
+class RetryBudget(object):
+    """
+    Process-wide cap on retries as a ratio of calls.
+
+    Every call deposits ``ratio`` tokens, every retry costs one, and at most
+    ``max_tokens`` are banked. Retries can't exceed ``ratio`` of the traffic
+    plus a ``max_tokens`` burst, so a brownout upstream does not get
+    ``retry_num`` times the load.
+    """
+    def __init__(self, ratio=0.1, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+default_retry_budget = RetryBudget()
+
+
+def is_transient(e):
+    """ Whether retrying ``e`` can help: connection errors, timeouts, 429 and 5xx """
+    status = getattr(e, 'status_code', None)
+    if status is None:
+        status = getattr(e, 'code', None) if isinstance(e, HTTPError) else getattr(e, 'status', None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                      URLError, ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    if aiohttp is not None and isinstance(e, aiohttp.ClientConnectionError):
+        return True
+    return False
+
+
+class _RetryPolicy(object):
+    """ Backoff, budget and deadline bookkeeping of one api_retry call """
+    def __init__(self, retry_num, backoff, max_backoff, jitter, retry_on, budget, deadline):
+        self.retry_num = retry_num
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = retry_on
+        self.budget = budget
+        self.expire_at = None if deadline is None else time.monotonic() + deadline
+        if budget is not None:
+            budget.deposit()
+
+    def remaining(self):
+        if self.expire_at is None:
+            return None
+        return self.expire_at - time.monotonic()
+
+    def next_delay(self, attempt, e):
+        """ Seconds to sleep before the next attempt, None to give up """
+        if attempt + 1 >= self.retry_num or not self.retry_on(e):
+            return None
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        if self.jitter:
+            # full jitter, spreads the retries of a fleet over the window
+            delay = random.uniform(0, delay)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        if self.budget is not None and not self.budget.withdraw():
+            logger.warning('retry budget exhausted, give up %s' % e)
+            return None
+        return delay
+
+    def cap_timeout(self, args, kwargs, signature):
+        """ args and kwargs of the next attempt, ``timeout`` capped to the time left """
+        remaining = self.remaining()
+        if remaining is None or signature is None:
+            return args, kwargs
+        try:
+            bound = signature.bind_partial(*args, **kwargs)
+        except TypeError:
+            # let the call itself report the bad arguments
+            return args, kwargs
+        timeout = bound.arguments.get('timeout', signature.parameters['timeout'].default)
+        bound.arguments['timeout'] = max(0.001, remaining if timeout is None else min(timeout, remaining))
+        return bound.args, bound.kwargs
+
+
+def _timeout_signature(func):
+    """ Signature of func if it has a ``timeout`` parameter with a default, else None """
+    try:
+        signature = inspect.signature(func)
+    except (TypeError, ValueError):
+        return None
+    parameter = signature.parameters.get('timeout')
+    if parameter is None or parameter.default is inspect.Parameter.empty:
+        return None
+    return signature
+
+
+def api_retry(retry_num=3, exception=Exception, raise_except=True, backoff=0.1, max_backoff=2.0,
+              jitter=True, retry_on=is_transient, budget=default_retry_budget, deadline=None):
+    """
+    Retry transient failures (``retry_on``, default ``is_transient``) up to
+    ``retry_num`` attempts with exponential backoff from ``backoff`` up to
+    ``max_backoff`` seconds, with full jitter. Other errors fail at once.
+    Retries are drawn from ``budget`` (None: unlimited). ``deadline``
+    seconds bound the whole call including sleeps, a ``timeout`` argument
+    of the wrapped function is capped to the time left.
+    """
     def decorator(func):
+        signature = _timeout_signature(func)
+        if inspect.iscoroutinefunction(func):
+            return _async_retry(func, retry_num, exception, raise_except, signature,
+                                backoff, max_backoff, jitter, retry_on, budget, deadline)
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            nonlocal exception
-            success = False
+            # per call: concurrent calls must never raise each other's error
+            last_error = exception
+            policy = _RetryPolicy(retry_num, backoff, max_backoff, jitter, retry_on, budget, deadline)
             for i in range(0, retry_num):
-                logger.debug('request count %s %s %s' % (i, args, kwargs))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('request count %s %s %s', i, _truncate(args, LOG_MAX_BYTES),
+                                 _truncate(kwargs, LOG_MAX_BYTES))
+                call_args, call_kwargs = policy.cap_timeout(args, kwargs, signature)
                 try:
-                    response = func(*args, **kwargs)
+                    return func(*call_args, **call_kwargs)
                 except Exception as e:
-                    logger.error('业务相关error %s' % e, exc_info=True)
-                    exception = e
-                    continue
-                else:
-                    return response
-            if isinstance(exception, (RequestException, URLError, HTTPError)):
+                    logger.error('业务相关error %s', e, exc_info=True)
+                    last_error = e
+                    delay = policy.next_delay(i, e)
+                    if delay is None:
+                        break
+                    time.sleep(delay)
+            if isinstance(last_error, (RequestException, URLError, HTTPError)):
                 pass
                 # 发送报警
-                # send_alarm(message=str(exception.args))
-            if not success:
-                if raise_except:
-                    raise exception
-                else:
-                    return {'result': "FAIL"}
+                # send_alarm(message=str(last_error.args))
+            if raise_except:
+                raise last_error
+            else:
+                return {'result': "FAIL"}
         return wrapper
     return decorator
 
 
+def _async_retry(func, retry_num, exception, raise_except, signature, *policy_args):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        last_error = exception
+        policy = _RetryPolicy(retry_num, *policy_args)
+        for i in range(0, retry_num):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('request count %s %s %s', i, _truncate(args, LOG_MAX_BYTES),
+                             _truncate(kwargs, LOG_MAX_BYTES))
+            call_args, call_kwargs = policy.cap_timeout(args, kwargs, signature)
+            try:
+                return await func(*call_args, **call_kwargs)
+            except Exception as e:
+                logger.error('业务相关error %s', e, exc_info=True)
+                last_error = e
+                delay = policy.next_delay(i, e)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+        if raise_except:
+            raise last_error
+        return {'result': "FAIL"}
+    return wrapper
+
+
+class CircuitOpenError(APIError):
+    """ Raised without calling the upstream while its circuit is open """
+
+
+class CircuitBreaker(object):
+    """
+    Per-upstream circuit breaker.
+
+    closed      calls pass, outcomes are counted over the last ``window``
+                seconds; once there are ``min_calls`` and the failure rate
+                reaches ``failure_rate`` the circuit opens
+    open        calls fail fast with CircuitOpenError for ``reset_timeout``
+                seconds, then the circuit goes half-open
+    half_open   up to ``half_open_calls`` trial calls pass; a success closes
+                the circuit, a failure opens it again; a trial that ends
+                without an outcome (cancelled) gives its slot back, and
+                trials not heard of for ``reset_timeout`` seconds open the
+                circuit again so it can't stay half open for good
+
+    Only transient errors (see is_transient) count as failures, a 4xx means
+    the upstream is up.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # the window is kept as this many time buckets of [start, successes, failures]
+    BUCKETS = 10
+
+    def __init__(self, name='', failure_rate=0.5, min_calls=20, window=10.0,
+                 reset_timeout=30.0, half_open_calls=1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.rejected = 0
+        self._trials = 0
+        self._trial_at = None
+        self._buckets = []
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Raise CircuitOpenError unless a call may go to the upstream now.
+        Every allowed call must end in record_result() (or record()).
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError('circuit open for %s' % self.name)
+                self.state = self.HALF_OPEN
+                self._trials = 0
+            if self.state == self.HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self.rejected += 1
+                    if now - self._trial_at >= self.reset_timeout:
+                        # the trials never reported back, probe again after a new timeout
+                        self._open()
+                    raise CircuitOpenError('circuit half open for %s' % self.name)
+                self._trials += 1
+                self._trial_at = now
+
+    def release(self):
+        """ Give back the trial slot of a call that ended without an outcome """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def record_result(self, status_code=None, error=None):
+        """
+        Outcome of an allowed call: its http status, or the error it raised.
+        Without either, or for a BaseException such as CancelledError, the
+        upstream was not judged and the trial slot is released.
+        """
+        if isinstance(error, Exception):
+            self.record_error(error)
+        elif error is None and status_code is not None:
+            self.record_status(status_code)
+        else:
+            self.release()
+
+    def record(self, ok):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    self.state = self.CLOSED
+                    self._buckets = []
+                else:
+                    self._open()
+                return
+            bucket = self._current_bucket()
+            bucket[1 if ok else 2] += 1
+            if not ok and self.state == self.CLOSED:
+                successes, failures = self._totals()
+                calls = successes + failures
+                if calls >= self.min_calls and failures >= self.failure_rate * calls:
+                    self._open()
+
+    def record_error(self, e):
+        self.record(not is_transient(e))
+
+    def record_status(self, status_code):
+        self.record(not (status_code == 429 or status_code >= 500))
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        logger.warning('circuit opened for %s' % self.name)
+
+    def _current_bucket(self):
+        now = time.monotonic()
+        width = self.window / self.BUCKETS
+        start = now - now % width
+        if not self._buckets or self._buckets[-1][0] != start:
+            self._buckets.append([start, 0, 0])
+            while self._buckets[0][0] <= now - self.window:
+                self._buckets.pop(0)
+        return self._buckets[-1]
+
+    def _totals(self):
+        horizon = time.monotonic() - self.window
+        successes = failures = 0
+        for start, ok, failed in self._buckets:
+            if start > horizon:
+                successes += ok
+                failures += failed
+        return successes, failures
+
+    def metrics(self):
+        with self._lock:
+            successes, failures = self._totals()
+            calls = successes + failures
+            return {
+                'name': self.name,
+                'state': self.state,
+                'successes': successes,
+                'failures': failures,
+                'failure_rate': failures / calls if calls else 0.0,
+                'rejected': self.rejected,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name, **options):
+    """
+    The CircuitBreaker shared by every client of upstream ``name``.
+    Raises ValueError when it already exists with other ``options``.
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name, **options)
+                return breaker
+    conflicts = ['%s=%r' % (key, getattr(breaker, key, None)) for key, value in sorted(options.items())
+                 if getattr(breaker, key, None) != value]
+    if conflicts:
+        raise ValueError('circuit breaker for %s already exists with %s, pass a CircuitBreaker '
+                         'to use other options' % (name, ', '.join(conflicts)))
+    return breaker
+
+
+def breaker_metrics():
+    """ metrics() of every circuit breaker, for exporting """
+    return [breaker.metrics() for breaker in list(_breakers.values())]
+
+
 @api_retry(raise_except=False)
 def request_api(
         url,
@@ -76,12 +673,10 @@ def request_api(
     headers['Accept'] = 'application/json'
 
     before_time = int(time.time() * 1000)
-    response = requests.request(http_method, url, params=query_params,
-                                headers=headers, data=data,
-                                files=files, timeout=timeout)
+    response = default_pool.request(http_method, url, params=query_params,
+                                    headers=headers, data=data,
+                                    files=files, timeout=timeout)
     consume_time = int(time.time() * 1000) - before_time
-    logger.info('请求API {url} {params} {data} 耗时{consume_time} '.format(
-        url=url, params=query_params, data=post_args, consume_time=consume_time))
 
     content_type = response.headers.get('content-type', 'application/json')
     if "application/json" in content_type:
@@ -91,27 +686,88 @@ def request_api(
     else:
         resp_data = response.text
     http_status = response.status_code
+    log_api_call(url, data, http_status, resp_data, consume_time)
     if http_status not in [200, 201]:
-        logger.error('请求API失败 {url} {data} {status} '
-                     '{resp_data}'.format(url=url, data=data, status=http_status, resp_data=resp_data))
         return
     if resp_data.get('result') in {'OK', 'ok', 1} or bool(resp_data.get('success')) is True \
-            or data.get('isValid') in {'True', 'true', True}:
+            or resp_data.get('isValid') in {'True', 'true', True}:
         resp_data['result'] = 'OK'
     else:
         resp_data['result'] = 'FAIL'
     return resp_data
 
 
+def _charset(content_type):
+    """ The charset parameter of a Content-Type, None if missing or unknown """
+    for param in content_type.split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            charset = value.strip().strip('"')
+            try:
+                codecs.lookup(charset)
+            except LookupError:
+                return None
+            return charset
+    return None
+
+
 class APIClient(object):
-    exception = Exception
+    exception = APIError
 
-    def __init__(self, base_url, headers=None, http_service=requests):
+    def __init__(self, base_url, headers=None, http_service=None, circuit_breaker=True,
+                 response_cache=None, log_sample_rate=LOG_SAMPLE_RATE, log_max_bytes=LOG_MAX_BYTES,
+                 slow_ms=SLOW_MS, rate_limit=None, rate_limit_timeout=None,
+                 compress_min_bytes=None, binary=False):
+        """
+        compress_min_bytes  gzip request bodies of at least this many bytes
+                            (Content-Encoding: gzip), None sends them as is;
+                            only for upstreams that accept gzip bodies
+        binary              ask for msgpack (Accept: application/msgpack,
+                            JSON as fallback), responses are decoded by
+                            their Content-Type either way
+        rate_limit          requests/s to base_url: a number (token bucket
+                            shared by the clients of base_url in this
+                            process, ValueError if they ask for different
+                            rates) or a ratelimit bucket, e.g. a
+                            FileTokenBucket shared by all workers on the box
+        rate_limit_timeout  max seconds to queue for a token, None waits as
+                            long as needed, 0 fails fast with RateLimitExceeded
+        log_sample_rate     share of successful calls logged, failures
+        log_max_bytes       and calls slower than slow_ms always are;
+        slow_ms             payloads are cut to log_max_bytes UTF-8 bytes
+        response_cache      http_cache.ResponseCache for GETs, honoring
+                            Cache-Control and revalidating with ETag /
+                            Last-Modified
+        circuit_breaker     True: the breaker shared by all clients of
+                            base_url, a dict: the same created with these
+                            CircuitBreaker options (ValueError if it already
+                            exists with other ones), or a CircuitBreaker,
+                            or False to disable
+        """
         if headers is None:
             headers = {}
+        if http_service is None:
+            http_service = default_pool
         self.base_url = base_url
         self.headers = headers
         self.http_service = http_service
+        if circuit_breaker is True:
+            circuit_breaker = get_breaker(base_url)
+        elif isinstance(circuit_breaker, dict):
+            circuit_breaker = get_breaker(base_url, **circuit_breaker)
+        self.breaker = circuit_breaker or None
+        self.response_cache = response_cache
+        if isinstance(rate_limit, (int, float)):
+            rate_limit = get_bucket(base_url, rate_limit)
+        self.rate_limiter = rate_limit
+        self.rate_limit_timeout = rate_limit_timeout
+        self.log_sample_rate = log_sample_rate
+        self.log_max_bytes = log_max_bytes
+        self.slow_ms = slow_ms
+        self.compress_min_bytes = compress_min_bytes
+        if binary and msgpack is None:
+            raise ImportError('binary=True requires msgpack')
+        self.binary = binary
 
     @api_retry()
     def fetch_json(
@@ -124,12 +780,184 @@ class APIClient(object):
             files=None,
             timeout=5):
         """ Fetch some JSON from Intel Atlas """
+        if query_params is None:
+            query_params = {}
+        url, headers, data = self._build_request(uri_path, http_method, headers, post_args, files)
 
-        # explicit values here to avoid mutable default values
-        if headers is None:
-            headers = self.headers
+        cache_key = entry = None
+        if self.response_cache is not None and http_method == 'GET':
+            cache_key = self.response_cache.key(url, query_params, headers)
+            entry = self.response_cache.get(cache_key)
+            if entry is not None:
+                if entry.fresh():
+                    return self._decode_cached(entry)
+                headers.update(entry.validators())
+
+        body = self._encode_body(headers, data)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(timeout=self.rate_limit_timeout)
+        if self.breaker is not None:
+            self.breaker.allow()
+        before_time = int(time.time() * 1000)
+        response = error = None
+        try:
+            if _is_grequests(self.http_service):
+                req = [self.http_service.request(http_method, url, params=query_params,
+                                                 headers=headers, data=body,
+                                                 files=files, timeout=timeout)]
+                response = self.http_service.map(req)[0]
+                if response is None:
+                    # grequests.map swallows the request's exception
+                    raise ConnectionError('request failed %s' % url)
+            else:
+                response = self.http_service.request(http_method, url, params=query_params,
+                                                     headers=headers, data=body,
+                                                     files=files, timeout=timeout)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if self.breaker is not None:
+                self.breaker.record_result(
+                    None if response is None else response.status_code, error)
+        consume_time = int(time.time() * 1000) - before_time
+
+        if cache_key is not None:
+            if response.status_code == 304 and entry is not None:
+                self.response_cache.refresh(cache_key, entry, response)
+                return self._decode_cached(entry)
+            if response.status_code == 200:
+                self.response_cache.store(cache_key, response)
+
+        resp_data = self._decode_body(response.headers.get('Content-Type', ''), response.content)
+        self._check_response(url, data, response.status_code, resp_data, consume_time)
+        return resp_data
+
+    def fetch_many(self, requests, concurrency=10, deadline=None):
+        """
+        Run many fetch_json calls on the process-wide fetch_many thread pool,
+        at most ``concurrency`` of them at once. The pool has
+        FETCH_MAX_WORKERS threads shared by all batches in flight, a larger
+        ``concurrency`` does not add threads. Once gevent has patched the
+        process (import grequests does) the calls run on greenlets instead.
+
+        ``requests`` items are an uri_path or a dict of fetch_json arguments.
+        Returns one FetchResult per item, in input order; a failing item
+        does not abort the others. ``deadline`` (seconds) bounds the whole
+        batch: per-call timeouts are capped to the time left, and items not
+        done by then get a TimeoutError.
+        """
+        requests = list(requests)
+        if not requests:
+            return []
+        expire_at = None if deadline is None else time.monotonic() + deadline
+
+        def call(request):
+            return self.fetch_json(**_fetch_kwargs(request, expire_at))
+
+        if _gevent_patched():
+            outcomes = _run_greenlets(call, requests, concurrency, expire_at)
+        else:
+            outcomes = _run_threads(call, requests, concurrency, expire_at)
+        results = []
+        for request, (done, result, error) in zip(requests, outcomes):
+            if not done:
+                error = TimeoutError('fetch_many deadline exceeded')
+            results.append(FetchResult(request, result, error))
+        return results
+
+    def stream_items(
+            self,
+            uri_path,
+            item_path='item',
+            http_method='GET',
+            headers=None,
+            query_params=None,
+            post_args=None,
+            timeout=5,
+            chunk_size=64 * 1024):
+        """
+        Yield records of a large JSON array or repeated XML element one at a
+        time instead of buffering and parsing the whole body, peak memory is
+        about one record.
+
+        item_path   JSON: ``item`` for a top level array, ``data.item`` for
+                    the array under key "data" (see stream_parse);
+                    XML: the repeated element's tag, e.g. ``row``
+        """
         if query_params is None:
             query_params = {}
+        url, headers, data = self._build_request(uri_path, http_method, headers, post_args, None)
+        http_service = default_pool if _is_grequests(self.http_service) else self.http_service
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(timeout=self.rate_limit_timeout)
+        if self.breaker is not None:
+            self.breaker.allow()
+        before_time = int(time.time() * 1000)
+        response = error = None
+        try:
+            response = http_service.request(http_method, url, params=query_params,
+                                            headers=headers, data=self._encode_body(headers, data),
+                                            timeout=timeout, stream=True)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if self.breaker is not None:
+                self.breaker.record_result(
+                    None if response is None else response.status_code, error)
+
+        consume_time = int(time.time() * 1000) - before_time
+
+        with response:
+            if response.status_code not in [200, 201]:
+                self._check_response(url, data, response.status_code, response.text, consume_time)
+            content_type = response.headers.get('content-type', 'application/json')
+            if 'xml' in content_type:
+                # let urllib3 undo gzip/deflate on the raw stream
+                response.raw.decode_content = True
+                yield from iter_xml_items(response.raw, item_path.split('.')[-1])
+            else:
+                yield from iter_json_items(response.iter_content(chunk_size), item_path)
+
+    def _decode_cached(self, entry):
+        return self._decode_body(entry.content_type, entry.body)
+
+    @staticmethod
+    def _decode_body(content_type, body):
+        """
+        Response body by its Content-Type: msgpack, else JSON, else text in
+        the response charset. JSON goes through the stdlib like
+        response.json(): big integers stay exact and NaN/Infinity parse.
+        """
+        charset = _charset(content_type)
+        if msgpack is not None and any(t in content_type for t in MSGPACK_TYPES):
+            try:
+                return msgpack.unpackb(body, raw=False)
+            except ValueError as e:
+                logger.debug('解析msgpack error %s' % e)
+        else:
+            try:
+                return json.loads(body.decode(charset) if charset else body)
+            except ValueError as e:
+                logger.debug('解析json error %s' % e)
+        return body.decode(charset or 'utf-8', 'replace')
+
+    def _encode_body(self, headers, data):
+        """ Request body as sent, gzipped from compress_min_bytes on """
+        if data is None or self.compress_min_bytes is None:
+            return data
+        body = data.encode('utf-8')
+        if len(body) < self.compress_min_bytes:
+            return body
+        headers['Content-Encoding'] = 'gzip'
+        return gzip.compress(body, COMPRESS_LEVEL)
+
+    def _build_request(self, uri_path, http_method, headers, post_args, files):
+        """ Full url, headers and body shared by the sync and async clients """
+        # explicit values here to avoid mutable default values, copy so
+        # concurrent calls never write into the shared self.headers
+        headers = dict(self.headers if headers is None else headers)
         if post_args is None:
             post_args = {}
 
@@ -142,37 +970,157 @@ class APIClient(object):
         if http_method in ("POST", "PUT", "DELETE") and not files:
             headers['Content-Type'] = 'application/json; charset=utf-8'
 
-        headers['Accept'] = 'application/json'
+        if self.binary:
+            headers['Accept'] = 'application/msgpack, application/json;q=0.9'
+        else:
+            headers['Accept'] = 'application/json'
 
         # construct the full URL without query parameters
         if uri_path[0] == '/':
             uri_path = uri_path[1:]
         url = '%s/%s' % (self.base_url, uri_path)
+        return url, headers, data
 
-        before_time = int(time.time() * 1000)
-        if self.http_service == grequests:
-            req = [self.http_service.request(http_method, url, params=query_params,
-                                             headers=headers, data=data,
-                                             files=files, timeout=timeout)]
-            response = grequests.map(req)[0]
-        else:
-            response = self.http_service.request(http_method, url, params=query_params,
-                                                 headers=headers, data=data,
-                                                 files=files, timeout=timeout)
-        consume_time = int(time.time() * 1000) - before_time
+    def _check_response(self, url, data, http_status, resp_data, consume_time):
+        log_api_call(url, data, http_status, resp_data, consume_time,
+                     self.log_sample_rate, self.log_max_bytes, self.slow_ms)
+        if http_status not in [200, 201]:
+            error = self.exception('请求API失败 {url} {data} {status} {resp_data}'.format(
+                url=url, data=_truncate(data, self.log_max_bytes), status=http_status,
+                resp_data=_truncate(resp_data, self.log_max_bytes)))
+            # lets api_retry tell transient (429/5xx) from final (4xx) failures
+            error.status_code = http_status
+            raise error
 
-        try:
-            resp_data = response.json()
-        except Exception as e:
-            logger.debug('解析json error %s' % e)
-            resp_data = response.text
 
-        http_status = response.status_code
-        if http_status not in [200, 201]:
-            raise self.exception('请求API失败 {url} {data} {status} '
-                                 '{resp_data}'.format(url=url, data=data, status=http_status, resp_data=resp_data))
+class AsyncAPIClient(APIClient):
+    """
+    asyncio version of APIClient on top of aiohttp
+
+        client = AsyncAPIClient('http://host', concurrency=200)
+        data = await client.fetch_json('/path')
+        await client.close()
+
+    All calls share one connection pool (``limit`` connections in total,
+    ``limit_per_host`` per host, 0 means no limit) and at most
+    ``concurrency`` calls are in flight at once, the rest wait their turn.
+    The session is created lazily inside the running loop. stream_items is
+    not supported.
+    """
+    def __init__(self, base_url, headers=None, concurrency=100, limit=100, limit_per_host=0,
+                 circuit_breaker=True, rate_limit=None, rate_limit_timeout=None,
+                 compress_min_bytes=None, binary=False):
+        if aiohttp is None:
+            raise ImportError('AsyncAPIClient requires aiohttp')
+        super(AsyncAPIClient, self).__init__(base_url, headers, circuit_breaker=circuit_breaker,
+                                             rate_limit=rate_limit, rate_limit_timeout=rate_limit_timeout,
+                                             compress_min_bytes=compress_min_bytes, binary=binary)
+        self.http_service = None
+        self.concurrency = concurrency
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self._session = None
+        self._semaphore = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    @api_retry()
+    async def fetch_json(
+            self,
+            uri_path,
+            http_method='GET',
+            headers=None,
+            query_params=None,
+            post_args=None,
+            files=None,
+            timeout=5):
+        if query_params is None:
+            query_params = {}
+        url, headers, data = self._build_request(uri_path, http_method, headers, post_args, files)
+        if files is not None:
+            body = aiohttp.FormData()
+            for name, value in files.items():
+                body.add_field(name, value)
         else:
-            logger.info('请求API成功 {url} {data} {status} {resp_data} 耗时{consume_time} '.format(
-                url=url, data=data, status=http_status, resp_data=resp_data, consume_time=consume_time))
+            body = self._encode_body(headers, data)
+
+        session = self._get_session()
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async(timeout=self.rate_limit_timeout)
+        if self.breaker is not None:
+            self.breaker.allow()
+        http_status = error = None
+        try:
+            # cancelled while queued here or in flight: the finally below
+            # gives a half-open trial slot back
+            async with self._semaphore:
+                before_time = int(time.time() * 1000)
+                async with session.request(http_method, url, params=query_params,
+                                           headers=headers, data=body,
+                                           timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    resp_data = self._decode_body(response.headers.get('Content-Type', ''),
+                                                  await response.read())
+                    http_status = response.status
+                consume_time = int(time.time() * 1000) - before_time
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if self.breaker is not None:
+                self.breaker.record_result(http_status, error)
 
+        self._check_response(url, data, http_status, resp_data, consume_time)
         return resp_data
+
+    async def fetch_many(self, requests, concurrency=None, deadline=None):
+        """
+        Coroutine version of APIClient.fetch_many, all items run as tasks
+        bounded by ``concurrency`` (defaults to the client's limit).
+        """
+        requests = list(requests)
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+        expire_at = None if deadline is None else time.monotonic() + deadline
+
+        async def call(request):
+            async with semaphore:
+                return await self.fetch_json(**_fetch_kwargs(request, expire_at))
+
+        tasks = [asyncio.ensure_future(call(request)) for request in requests]
+        if tasks:
+            await asyncio.wait(tasks, timeout=deadline)
+        late = [task for task in tasks if not task.done()]
+        for task in late:
+            task.cancel()
+        if late:
+            # let the cancelled calls release their semaphore and connection
+            await asyncio.gather(*late, return_exceptions=True)
+        results = []
+        for request, task in zip(requests, tasks):
+            if task.cancelled():
+                results.append(FetchResult(request, None, TimeoutError('fetch_many deadline exceeded')))
+            elif task.exception() is not None:
+                results.append(FetchResult(request, None, task.exception()))
+            else:
+                results.append(FetchResult(request, task.result(), None))
+        return results
+
+    def stream_items(self, *args, **kwargs):
+        # stream_parse pulls its chunks synchronously, it can't read an aiohttp body
+        raise NotImplementedError('AsyncAPIClient has no stream_items, use APIClient.stream_items '
+                                  '(e.g. in asyncio.to_thread) or fetch_json')
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,364 @@
+"""
+APIClient 压测
+    本地起一个stub http server(可配置延迟/响应大小/错误率),
+    以固定并发调用 request_api / fetch_json / fetch_many / AsyncAPIClient,
+    统计吞吐, p50/p99延迟, CPU, RSS, 结果保存为json便于对比
+
+    python api_bench.py --concurrency 1,8,32 --requests 2000 --latency 0.005 --output run1.json
+    python api_bench.py --memory      # fetch_json vs stream_items 内存峰值
+    python api_bench.py --breaker     # 熔断器对不稳定上游的表现
+    python api_bench.py --encoding    # json/msgpack/gzip 传输大小与编解码耗时
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import timeit
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import APIClient
+import serializer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, with Nagle on the body
+    # waits for the client's delayed ACK (~40 ms) on a reused connection
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(payload_size=1024, error_rate=0.0, latency=0.0, body_path=None):
+    """ Run the stub server on a free port until killed, the port is printed first """
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    httpd.daemon_threads = True
+    httpd.latency = latency
+    httpd.error_rate = error_rate
+    if body_path:
+        with open(body_path, 'rb') as f:
+            httpd.body = f.read()
+    else:
+        httpd.body = json.dumps({'result': 'ok', 'data': 'x' * payload_size}).encode()
+    print(httpd.server_address[1], flush=True)
+    httpd.serve_forever()
+
+
+class StubServer(object):
+    """
+    Local JSON server on a free port, run in a child process so that its
+    threads and CPU stay out of the measured client.
+    Every request waits ``latency`` seconds, ``error_rate`` of them get a
+    503. ``body`` replaces the default ``payload_size`` bytes payload.
+    """
+    def __init__(self, payload_size=1024, error_rate=0.0, latency=0.0, body=None):
+        self.payload_size = payload_size
+        self.error_rate = error_rate
+        self.latency = latency
+        self.body = body
+        self.process = None
+        self.port = None
+        self._body_path = None
+
+    def __enter__(self):
+        args = [sys.executable, os.path.abspath(__file__), '--serve', '--payload', str(self.payload_size),
+                '--error-rate', str(self.error_rate), '--latency', str(self.latency)]
+        if self.body is not None:
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+                f.write(self.body)
+            self._body_path = f.name
+            args += ['--body', self._body_path]
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        line = self.process.stdout.readline()
+        if not line:
+            self.__exit__()
+            raise RuntimeError('stub server did not start')
+        self.port = int(line)
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+        if self._body_path:
+            os.remove(self._body_path)
+            self._body_path = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.port
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def rss_mb():
+    """ Current resident set size, falls back to the peak where /proc is missing """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024
+    except (IOError, OSError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return peak / 1024.0 / 1024 if sys.platform == 'darwin' else peak / 1024.0
+
+
+class _Meter(object):
+    """ Wall time, CPU time, RSS and call latencies of one run """
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.rss_before = rss_mb()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+
+    def add(self, latency, ok, calls=1):
+        with self.lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += calls
+
+    def result(self, label, concurrency, requests):
+        latencies = sorted(self.latencies)
+        rss = rss_mb()
+        return {
+            'label': label,
+            'concurrency': concurrency,
+            'requests': requests,
+            'errors': self.errors,
+            'seconds': self.wall,
+            'rps': requests / self.wall if self.wall else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+            # CPU of this process, the stub server runs in its own
+            'cpu_seconds': self.cpu,
+            'cpu_percent': self.cpu / self.wall * 100 if self.wall else 0.0,
+            'rss_mb': rss,
+            'rss_delta_mb': rss - self.rss_before,
+        }
+
+
+def run_load(func, concurrency=8, total=2000, label=''):
+    """ Call ``func()`` ``total`` times from ``concurrency`` threads, it fails by raising """
+    if APIClient._gevent_patched():
+        # OS threads block forever on gevent's patched socket and queue
+        raise RuntimeError('run_load needs an interpreter not patched by gevent (import grequests)')
+    meter = _Meter()
+
+    def call():
+        started = time.perf_counter()
+        ok = True
+        try:
+            func()
+        except Exception:
+            ok = False
+        meter.add(time.perf_counter() - started, ok)
+
+    with meter:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for _ in range(total):
+                pool.submit(call)
+    return meter.result(label, concurrency, total)
+
+
+def run_batches(client, path, concurrency=8, total=2000, batch_size=100, label='fetch_many'):
+    """ ``total`` calls as fetch_many batches, latency is per batch """
+    meter = _Meter()
+    with meter:
+        for start in range(0, total, batch_size):
+            count = min(batch_size, total - start)
+            started = time.perf_counter()
+            results = client.fetch_many([path] * count, concurrency=concurrency)
+            failed = sum(not r.ok for r in results)
+            meter.add(time.perf_counter() - started, not failed, failed)
+    return meter.result('%s(batch=%d)' % (label, batch_size), concurrency, total)
+
+
+def run_async(base_url, path, concurrency=8, total=2000, label='AsyncAPIClient.fetch_json'):
+    """ ``total`` coroutine calls, at most ``concurrency`` in flight """
+    meter = _Meter()
+
+    async def main():
+        client = APIClient.AsyncAPIClient(base_url, concurrency=concurrency, limit=concurrency,
+                                          circuit_breaker=False)
+        async with client:
+            async def call():
+                started = time.perf_counter()
+                ok = True
+                try:
+                    await client.fetch_json(path)
+                except Exception:
+                    ok = False
+                meter.add(time.perf_counter() - started, ok)
+            await asyncio.gather(*[call() for _ in range(total)])
+
+    with meter:
+        asyncio.run(main())
+    return meter.result(label, concurrency, total)
+
+
+def print_result(result):
+    print('{label:<32} c={concurrency:<4} {rps:>9.1f} req/s  p50 {p50_ms:>7.2f} ms  '
+          'p99 {p99_ms:>7.2f} ms  cpu {cpu_percent:>5.1f}%  rss {rss_mb:>6.1f} MB  '
+          'errors {errors}'.format(**result))
+
+
+def run_suite(concurrency_levels, total, latency, payload_size, error_rate):
+    results = []
+    with StubServer(payload_size=payload_size, error_rate=error_rate, latency=latency) as server:
+        url = server.url + '/ping'
+        client = APIClient.APIClient(server.url, circuit_breaker=False)
+
+        def request_api():
+            if APIClient.request_api(url) is None:
+                raise APIClient.APIError('request_api failed')
+
+        scenarios = [
+            ('requests.request', lambda: requests.request('GET', url, timeout=5)),
+            ('request_api', request_api),
+            ('fetch_json', lambda: client.fetch_json('/ping')),
+        ]
+        for concurrency in concurrency_levels:
+            for label, func in scenarios:
+                results.append(run_load(func, concurrency, total, label))
+                print_result(results[-1])
+            results.append(run_batches(client, '/ping', concurrency, total))
+            print_result(results[-1])
+            if APIClient.aiohttp is not None:
+                results.append(run_async(server.url, '/ping', concurrency, total))
+                print_result(results[-1])
+    return results
+
+
+def bench_memory(records=200000):
+    """ Peak traced memory: fetch_json buffers the whole body, stream_items one record """
+    rows = [{'id': i, 'name': 'record %d' % i, 'values': list(range(20))} for i in range(records)]
+    with StubServer(body=json.dumps({'data': rows}).encode()) as server:
+        del rows
+        client = APIClient.APIClient(server.url)
+        for label, run in (('fetch_json', lambda: len(client.fetch_json('/export')['data'])),
+                           ('stream_items', lambda: sum(1 for _ in client.stream_items('/export', 'data.item')))):
+            tracemalloc.start()
+            count = run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('%-13s %d records, peak %.1f MB' % (label, count, peak / 1024.0 / 1024))
+
+
+def bench_breaker(error_rate=0.8):
+    """ Circuit breaker against a flaky upstream """
+    with StubServer(error_rate=error_rate) as server:
+        client = APIClient.APIClient(server.url, circuit_breaker={'min_calls': 10, 'reset_timeout': 1})
+        results = client.fetch_many(['/flaky'] * 100, concurrency=8)
+        print('flaky upstream: %d ok, %d failed' % (
+            sum(r.ok for r in results), sum(not r.ok for r in results)))
+        print(client.breaker.metrics())
+
+
+def bench_encoding(records=5000, number=20):
+    """ Wire size and encode/decode time per body format """
+    rows = [{'id': i, 'name': 'record %d' % i, 'price': i * 1.5, 'tags': ['a', 'b', 'c'],
+             'active': i % 2 == 0} for i in range(records)]
+    formats = [('json', serializer.dumpb, serializer.loads)]
+    if APIClient.msgpack is not None:
+        formats.append(('msgpack', APIClient.msgpack.packb,
+                        lambda body: APIClient.msgpack.unpackb(body, raw=False)))
+    for name, encode, decode in formats:
+        body = encode(rows)
+        zipped = gzip.compress(body, APIClient.COMPRESS_LEVEL)
+        encode_ms = timeit.timeit(lambda: encode(rows), number=number) / number * 1000
+        decode_ms = timeit.timeit(lambda: decode(body), number=number) / number * 1000
+        gzip_ms = timeit.timeit(lambda: gzip.compress(body, APIClient.COMPRESS_LEVEL),
+                                number=number) / number * 1000
+        gunzip_ms = timeit.timeit(lambda: gzip.decompress(zipped), number=number) / number * 1000
+        print('%-8s %8d bytes  gzip %7d bytes  encode %6.2f ms  decode %6.2f ms  '
+              'gzip %6.2f ms  gunzip %5.2f ms' % (name, len(body), len(zipped), encode_ms,
+                                                  decode_ms, gzip_ms, gunzip_ms))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='APIClient load test against a local stub server')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma separated levels')
+    parser.add_argument('--requests', type=int, default=2000, help='calls per scenario and level')
+    parser.add_argument('--latency', type=float, default=0.0, help='stub latency, seconds')
+    parser.add_argument('--payload', type=int, default=1024, help='stub payload size, bytes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 answers')
+    parser.add_argument('--output', help='save the results to this json file')
+    parser.add_argument('--memory', action='store_true', help='run the streaming memory benchmark')
+    parser.add_argument('--breaker', action='store_true', help='run the circuit breaker demo')
+    parser.add_argument('--encoding', action='store_true', help='compare json, msgpack and gzip bodies')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--body', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.payload, args.error_rate, args.latency, args.body)
+    elif args.memory:
+        bench_memory()
+    elif args.breaker:
+        bench_breaker()
+    elif args.encoding:
+        bench_encoding()
+    else:
+        levels = [int(level) for level in args.concurrency.split(',')]
+        suite_results = run_suite(levels, args.requests, args.latency, args.payload, args.error_rate)
+        if args.output:
+            report = {
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'config': vars(args),
+                'results': suite_results,
+            }
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+            print('saved %s' % args.output)
@@ -3,7 +3,98 @@
 # @Time 2019/12/26 20:11
 
 """
+import os
+import time
+import types
+import atexit
+import pickle
+import sqlite3
+import asyncio
+import hashlib
+import inspect
+import logging
 import functools
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+try:
+    from profile.perftimer import PerfTimer
+except ImportError:
+    PerfTimer = None
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize',
+                                     'evictions', 'loads', 'load_time'])
+
+logger = logging.getLogger('cache')
+
+# name -> cache, every named cache in this module registers itself here
+_registry = weakref.WeakValueDictionary()
+
+_MISSING = object()
+_KWD_MARK = object()
+_FAST_TYPES = {int, str}
+# their repr() is the same in every process and tells any two values apart
+_STABLE_TYPES = {str, bytes, int, float, bool, type(None)}
+
+
+def cache_stats():
+    """ CacheInfo of every live named cache, keyed by name """
+    return {name: cache.info() for name, cache in list(_registry.items())}
+
+
+def _report_load(name, elapsed):
+    # loads show up as the "cache" category in PerfTimer.report()
+    if PerfTimer is not None:
+        PerfTimer.get_instance().log_time(name, 'cache', elapsed, (), {})
+
+
+class SingleFlight(object):
+    """
+    Collapse concurrent calls for the same key into one computation.
+
+    The first caller for a key runs the function, callers arriving while it
+    is in flight wait and get its result or its exception. The per-key entry
+    is dropped as soon as the call completes, so the table only holds keys
+    that are currently being computed.
+    """
+    class _Call(object):
+        __slots__ = ('event', 'result', 'exc')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.exc = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.event.wait()
+            if call.exc is not None:
+                raise call.exc
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.exc = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def __len__(self):
+        return len(self._calls)
 
 
 class CacheProperty(object):
@@ -13,29 +104,798 @@ class CacheProperty(object):
 
     Optional ``name`` argument allows you to make cached properties of other
     methods. (e.g.  url = cached_property(get_absolute_url, name='url') )
+
+    With ``single_flight=True`` threads racing on a cold instance compute
+    the value once (e.g. ``@CacheProperty(single_flight=True)``).
     """
-    def __init__(self, func, name=None):
+    def __init__(self, func=None, name=None, single_flight=False):
+        self.name = name
+        self.flight = SingleFlight() if single_flight else None
+        # hits never reach a non-data descriptor, only loads are counted
+        self.loads = 0
+        self.load_time = 0.0
+        if func is not None:
+            self(func)
+
+    def __call__(self, func):
         self.func = func
         self.__doc__ = getattr(func, '__doc__')
-        self.name = name or func.__name__
+        self.name = self.name or func.__name__
+        self.fullname = '%s.%s' % (func.__module__, func.__qualname__)
+        _registry[self.fullname] = self
+        return self
 
     def __get__(self, instance, type=None):
         if instance is None:
             return self
+        if self.flight is not None:
+            return self.flight.do(id(instance), self._load, instance)
+        return self._compute(instance)
+
+    def _load(self, instance):
+        # another thread may have finished while we queued for the flight
+        if self.name in instance.__dict__:
+            return instance.__dict__[self.name]
+        return self._compute(instance)
+
+    def _compute(self, instance):
+        started = time.perf_counter()
         res = instance.__dict__[self.name] = self.func(instance)
+        elapsed = time.perf_counter() - started
+        self.loads += 1
+        self.load_time += elapsed
+        _report_load(self.fullname, elapsed)
         return res
 
+    def info(self):
+        return CacheInfo(None, self.loads, None, None, 0, self.loads, self.load_time)
+
+
+class SlotCacheProperty(object):
+    """
+    CacheProperty for ``__slots__`` classes: the value is kept in a reserved
+    slot, ``_cached_<name>`` unless ``slot`` says otherwise, which the class
+    has to declare. Also works on ordinary classes.
+
+    ``ttl`` recomputes the value after that many seconds, ``del obj.name``
+    (or ``Cls.name.reset(obj)``) drops it. Threads racing on a cold value
+    compute it once.
+
+        class Point(object):
+            __slots__ = ('x', 'y', '_cached_norm')
+
+            @SlotCacheProperty
+            def norm(self):
+                return (self.x ** 2 + self.y ** 2) ** 0.5
+    """
+    def __init__(self, func=None, slot=None, ttl=None, timer=time.monotonic):
+        self.slot = slot
+        self.ttl = ttl
+        self.timer = timer
+        self.flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_time = 0.0
+        if func is not None:
+            self(func)
+
+    def __call__(self, func):
+        self.func = func
+        self.__doc__ = getattr(func, '__doc__')
+        self.name = func.__name__
+        self.slot = self.slot or '_cached_' + func.__name__
+        self.fullname = '%s.%s' % (func.__module__, func.__qualname__)
+        _registry[self.fullname] = self
+        return self
+
+    def __get__(self, instance, type=None):
+        if instance is None:
+            return self
+        value = self._lookup(instance)
+        if value is _MISSING:
+            self.misses += 1
+            return self.flight.do(id(instance), self._load, instance)
+        self.hits += 1
+        return value
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, None, None, 0, self.loads, self.load_time)
+
+    def __set__(self, instance, value):
+        setattr(instance, self.slot, self._entry(value))
+
+    def __delete__(self, instance):
+        self.reset(instance)
+
+    def reset(self, instance):
+        try:
+            delattr(instance, self.slot)
+        except AttributeError:
+            pass
+
+    def _entry(self, value):
+        if self.ttl is None:
+            return value
+        return value, self.timer() + self.ttl
+
+    def _lookup(self, instance):
+        entry = getattr(instance, self.slot, _MISSING)
+        if entry is _MISSING or self.ttl is None:
+            return entry
+        if entry[1] <= self.timer():
+            return _MISSING
+        return entry[0]
+
+    def _load(self, instance):
+        value = self._lookup(instance)
+        if value is _MISSING:
+            started = time.perf_counter()
+            value = self.func(instance)
+            setattr(instance, self.slot, self._entry(value))
+            elapsed = time.perf_counter() - started
+            self.loads += 1
+            self.load_time += elapsed
+            _report_load(self.fullname, elapsed)
+        return value
+
+
+class LRUCache(object):
+    """
+    Bounded mapping with least-recently-used eviction and optional ttl.
+
+    Entries live in an OrderedDict so lookup, refresh and eviction are all O(1).
+    ``maxsize=None`` means unbounded, ``ttl`` is in seconds. A ``name``
+    registers the cache with ``cache_stats()`` and labels its loads in
+    PerfTimer reports.
+    """
+    def __init__(self, maxsize=128, ttl=None, timer=time.monotonic, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.name = name or 'cache-%x' % id(self)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_time = 0.0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if name is not None:
+            _registry[name] = self
+
+    def get(self, key, default=None):
+        # The hit path takes no lock: single OrderedDict operations are atomic
+        # under the GIL, only writes and evictions need to be serialized.
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expire_at = entry
+        if expire_at is not None and expire_at <= self.timer():
+            self.delete(key)
+            self.misses += 1
+            return default
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            # evicted by another thread in between
+            pass
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """ Like get, but leaves recency order and hit/miss counters alone """
+        entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= self.timer()):
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        expire_at = None if self.ttl is None else self.timer() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def items(self):
+        """ Unexpired (key, value) pairs, least recently used first """
+        now = self.timer()
+        with self._lock:
+            return [(k, v) for k, (v, expire_at) in self._data.items()
+                    if expire_at is None or expire_at > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = self.loads = 0
+            self.load_time = 0.0
+
+    def record_load(self, elapsed):
+        """ Account ``elapsed`` seconds spent producing a missing value """
+        self.loads += 1
+        self.load_time += elapsed
+        _report_load(self.name, elapsed)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data),
+                         self.evictions, self.loads, self.load_time)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _HashedSeq(list):
+    """
+    Key tuple that hashes itself only once, dict lookups re-hash keys on
+    every probe otherwise.
+    """
+    __slots__ = 'hashvalue'
+
+    def __init__(self, tup, hash=hash):
+        self[:] = tup
+        self.hashvalue = hash(tup)
+
+    def __hash__(self):
+        return self.hashvalue
+
+
+def make_key(args, kwargs, typed=False, sort_kwargs=True):
+    """
+    Build a hashable cache key from call arguments without repr-ing them.
+
+    ``f(1, '2')`` and ``f('1', 2)`` get distinct keys. With ``typed`` the
+    argument types are part of the key as well (``f(1)`` vs ``f(1.0)``).
+    With ``sort_kwargs`` keyword order does not matter.
+    Raises TypeError for unhashable arguments, pass a ``key`` callable to
+    memoize for those.
+    """
+    key = args
+    if kwargs:
+        items = sorted(kwargs.items()) if sort_kwargs else tuple(kwargs.items())
+        key += (_KWD_MARK,)
+        for item in items:
+            key += item
+    if typed:
+        key += tuple(type(v) for v in args)
+        if kwargs:
+            key += tuple(type(v) for _, v in items)
+    elif len(key) == 1 and type(key[0]) in _FAST_TYPES:
+        return key[0]
+    return _HashedSeq(key)
+
+
+def _stable_repr(value):
+    """ repr() of a tiered_memoize argument, made only of _STABLE_TYPES and tuples of them """
+    if type(value) is tuple:
+        return '(%s)' % ''.join(_stable_repr(v) + ',' for v in value)
+    if type(value) in _STABLE_TYPES:
+        return repr(value)
+    raise TypeError('%s argument has no stable repr for a shared cache key, '
+                    'pass tiered_memoize a key= returning a string' % type(value).__name__)
+
+
+def _hash_code(code, sha):
+    # repr() of a nested code object carries its address, hash its parts instead
+    sha.update(code.co_code)
+    sha.update(repr((code.co_names, code.co_varnames, code.co_freevars)).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, sha)
+        elif isinstance(const, frozenset):
+            # set order changes with the string hash seed
+            sha.update(repr(sorted(repr(v) for v in const)).encode('utf-8'))
+        else:
+            sha.update(repr(const).encode('utf-8'))
+
+
+def function_version(func):
+    """ Fingerprint of a function's code, the same in every process until its body changes """
+    sha = hashlib.sha1('{}.{}'.format(func.__module__, func.__qualname__).encode('utf-8'))
+    _hash_code(func.__code__, sha)
+    return sha.hexdigest()
 
-def memoize(obj):
+
+class SqliteStore(object):
+    """
+    On-disk snapshot of a memoize cache, so a restarted worker starts warm.
+
+    Entries are looked up lazily on local misses rather than loaded upfront.
+    Each ``namespace`` (one per function) carries a ``version``; opening the
+    store with a different version discards that namespace's old entries.
+    The connection is opened on first use and again in every forked child,
+    sqlite connections must not cross fork().
+    """
+    def __init__(self, path, namespace, version, ttl=None, serializer=pickle):
+        self.path = path
+        self.namespace = namespace
+        self.version = version
+        self.ttl = ttl
+        self.serializer = serializer
+        self._lock = threading.Lock()
+        self._conn = self._inherited = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        """ This process's connection, call with self._lock held """
+        if self._pid != os.getpid():
+            # keep a connection inherited from the parent referenced and
+            # unused, closing it here would release the parent's sqlite locks
+            self._inherited = self._conn
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+            self._check_version(self._conn)
+        return self._conn
+
+    def _check_version(self, conn):
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS memoize_meta '
+                         '(namespace TEXT PRIMARY KEY, version TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS memoize_entries '
+                         '(namespace TEXT, key BLOB, value BLOB, saved_at REAL, '
+                         'PRIMARY KEY (namespace, key))')
+            row = conn.execute('SELECT version FROM memoize_meta WHERE namespace = ?',
+                               (self.namespace,)).fetchone()
+            if row is None or row[0] != self.version:
+                conn.execute('DELETE FROM memoize_entries WHERE namespace = ?', (self.namespace,))
+                conn.execute('INSERT OR REPLACE INTO memoize_meta VALUES (?, ?)',
+                             (self.namespace, self.version))
+
+    @staticmethod
+    def dump_key(key):
+        # pickled keys are compared as bytes, they are never loaded back
+        if isinstance(key, _HashedSeq):
+            key = tuple(key)
+        return pickle.dumps(key, protocol=4)
+
+    def get(self, key, default=None):
+        try:
+            raw_key = self.dump_key(key)
+        except Exception:
+            return default
+        with self._lock:
+            row = self.conn.execute('SELECT value, saved_at FROM memoize_entries '
+                                    'WHERE namespace = ? AND key = ?',
+                                    (self.namespace, raw_key)).fetchone()
+        if row is None or (self.ttl is not None and row[1] + self.ttl <= time.time()):
+            return default
+        return self.serializer.loads(row[0])
+
+    def snapshot(self, items):
+        """ Replace the stored entries of this namespace with ``items`` """
+        rows = []
+        now = time.time()
+        for key, value in items:
+            try:
+                rows.append((self.namespace, self.dump_key(key),
+                             self.serializer.dumps(value), now))
+            except Exception as e:
+                logger.debug('skip unpicklable cache entry %s' % e)
+        with self._lock:
+            conn = self.conn
+            with conn:
+                conn.execute('DELETE FROM memoize_entries WHERE namespace = ?', (self.namespace,))
+                conn.executemany('INSERT OR REPLACE INTO memoize_entries VALUES (?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._conn.close()
+            self._conn = self._pid = None
+
+
+def memoize(obj=None, maxsize=128, ttl=None, typed=False, sort_kwargs=True, key=None,
+            single_flight=False, persist=None, persist_size=None, version=None):
     """
     Local cache of the function return value
+
+    Can be used bare (``@memoize``) or with options
+    (``@memoize(maxsize=1024, ttl=60)``). At most ``maxsize`` results are kept,
+    least recently used first out; ``maxsize=None`` disables the bound.
+    ``ttl`` expires entries after that many seconds.
+
+    ``typed`` and ``sort_kwargs`` are passed to ``make_key``. For unhashable
+    arguments pass ``key``, a callable taking the same arguments as the
+    function and returning a hashable key.
+
+    ``single_flight=True`` makes concurrent callers missing on the same key
+    wait for one computation instead of each running the function.
+
+    ``async def`` functions get a coroutine wrapper caching the awaited
+    result. Concurrent awaiters of a missing key always share one task.
+
+    ``persist`` is a sqlite file path: local misses then fall back to the
+    last snapshot there, and ``cache_snapshot()`` (also run at exit) saves
+    the ``persist_size`` most recently used entries. Snapshots are tied to
+    ``version``, by default a fingerprint of the function's code, so they
+    are dropped once the function changes.
     """
-    cache = obj.cache = {}
+    if obj is None:
+        return functools.partial(memoize, maxsize=maxsize, ttl=ttl, typed=typed,
+                                 sort_kwargs=sort_kwargs, key=key,
+                                 single_flight=single_flight, persist=persist,
+                                 persist_size=persist_size, version=version)
+
+    cache = LRUCache(maxsize=maxsize, ttl=ttl,
+                     name='%s.%s' % (obj.__module__, obj.__qualname__))
+    store = None
+    if persist is not None:
+        store = SqliteStore(persist, '%s.%s' % (obj.__module__, obj.__qualname__),
+                            version or function_version(obj), ttl=ttl)
+    if inspect.iscoroutinefunction(obj):
+        memoizer = _async_memoize(obj, cache, store, typed, sort_kwargs, key)
+        return _attach_snapshot(memoizer, cache, store, persist_size)
+    flight = SingleFlight() if single_flight else None
+
+    def compute(cache_key, args, kwargs):
+        started = time.perf_counter()
+        result = _MISSING
+        if store is not None:
+            result = store.get(cache_key, _MISSING)
+        if result is _MISSING:
+            result = obj(*args, **kwargs)
+        cache.record_load(time.perf_counter() - started)
+        return result
+
+    def load(cache_key, args, kwargs):
+        # re-check, the previous flight for this key may just have landed
+        result = cache.peek(cache_key, _MISSING)
+        if result is _MISSING:
+            result = compute(cache_key, args, kwargs)
+            cache.set(cache_key, result)
+        return result
 
     @functools.wraps(obj)
     def memoizer(*args, **kwargs):
-        key = str(args) + str(kwargs)
-        if key not in cache:
-            cache[key] = obj(*args, **kwargs)
-        return cache[key]
+        if key is None:
+            cache_key = make_key(args, kwargs, typed, sort_kwargs)
+        else:
+            cache_key = key(*args, **kwargs)
+        result = cache.get(cache_key, _MISSING)
+        if result is _MISSING:
+            if flight is not None:
+                return flight.do(cache_key, load, cache_key, args, kwargs)
+            result = compute(cache_key, args, kwargs)
+            cache.set(cache_key, result)
+        return result
+
+    memoizer.cache = cache
+    memoizer.cache_info = cache.info
+    memoizer.cache_clear = cache.clear
+    return _attach_snapshot(memoizer, cache, store, persist_size)
+
+
+def _attach_snapshot(memoizer, cache, store, persist_size):
+    if store is None:
+        return memoizer
+
+    def cache_snapshot():
+        items = cache.items()
+        if persist_size is not None:
+            items = items[-persist_size:]
+        return store.snapshot(items)
+
+    memoizer.store = store
+    memoizer.cache_snapshot = cache_snapshot
+    atexit.register(cache_snapshot)
     return memoizer
+
+
+def _async_memoize(obj, cache, store, typed, sort_kwargs, key):
+    pending = {}
+
+    async def load(cache_key, args, kwargs):
+        started = time.perf_counter()
+        result = _MISSING
+        if store is not None:
+            result = store.get(cache_key, _MISSING)
+        if result is _MISSING:
+            result = await obj(*args, **kwargs)
+        cache.set(cache_key, result)
+        cache.record_load(time.perf_counter() - started)
+        return result
+
+    def forget(cache_key, task):
+        if pending.get(cache_key) is task:
+            del pending[cache_key]
+
+    @functools.wraps(obj)
+    async def memoizer(*args, **kwargs):
+        if key is None:
+            cache_key = make_key(args, kwargs, typed, sort_kwargs)
+        else:
+            cache_key = key(*args, **kwargs)
+        result = cache.get(cache_key, _MISSING)
+        if result is not _MISSING:
+            return result
+        loop = asyncio.get_running_loop()
+        task = pending.get(cache_key)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(load(cache_key, args, kwargs))
+            pending[cache_key] = task
+            task.add_done_callback(functools.partial(forget, cache_key))
+        # shield: one cancelled awaiter must not cancel the shared load
+        return await asyncio.shield(task)
+
+    memoizer.cache = cache
+    memoizer.cache_info = cache.info
+    memoizer.cache_clear = cache.clear
+    return memoizer
+
+
+class MemoryRedis(object):
+    """
+    In-memory stand-in for the slice of the redis client tiered_memoize
+    uses, for tests and for running without a redis server.
+    """
+    class _Pipeline(object):
+        def __init__(self, client):
+            self.client = client
+            self.commands = []
+
+        def __getattr__(self, name):
+            method = getattr(self.client, name)
+
+            def queue(*args, **kwargs):
+                self.commands.append((method, args, kwargs))
+                return self
+            return queue
+
+        def execute(self):
+            commands, self.commands = self.commands, []
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+    def __init__(self, timer=time.monotonic):
+        self.timer = timer
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._data.get(name)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= self.timer():
+                del self._data[name]
+                return None
+            return entry[0]
+
+    def set(self, name, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        with self._lock:
+            self._data[name] = (value, None if ex is None else self.timer() + ex)
+        return True
+
+    def setex(self, name, time, value):
+        return self.set(name, value, ex=time)
+
+    def mget(self, keys):
+        return [self.get(name) for name in keys]
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+    def pipeline(self, transaction=True):
+        return self._Pipeline(self)
+
+
+def tiered_memoize(client, ttl=300, l1_maxsize=1024, l1_ttl=5, prefix=None,
+                   serializer=pickle, typed=False, sort_kwargs=True, key=None,
+                   single_flight=False):
+    """
+    Two tier cache of the function return value: an in-process LRUCache (L1)
+    in front of redis (L2) shared by every worker.
+
+    ``client`` is a redis client (or ``MemoryRedis``). Values stay ``ttl``
+    seconds in redis and only ``l1_ttl`` seconds in the local tier, which
+    bounds how long workers can disagree after an entry changes.
+    ``serializer`` is anything with ``dumps``/``loads`` (pickle, json, ...).
+    Redis errors degrade to computing the value locally.
+    Redis keys are built from the arguments' repr(), so arguments must be
+    str, bytes, int, float, bool, None or tuples of those (TypeError
+    otherwise); pass ``key`` returning a string for anything else.
+
+    The wrapper has ``get_many(arg_tuples)`` resolving many calls with one
+    pipelined round trip, and ``invalidate(*args, **kwargs)``.
+    """
+    def decorator(obj):
+        name = prefix or 'memoize:%s.%s' % (obj.__module__, obj.__qualname__)
+        l1 = LRUCache(maxsize=l1_maxsize, ttl=l1_ttl, name=name)
+        flight = SingleFlight() if single_flight else None
+
+        def local_key(args, kwargs):
+            if key is None:
+                return make_key(args, kwargs, typed, sort_kwargs)
+            return key(*args, **kwargs)
+
+        def remote_key(args, kwargs):
+            # repr rather than hash(): it has to be stable across processes
+            if key is None:
+                items = tuple(sorted(kwargs.items())) if sort_kwargs else tuple(kwargs.items())
+                raw = _stable_repr(args) + _stable_repr(items)
+                if typed:
+                    raw += repr(tuple(type(v).__name__ for v in args + tuple(v for _, v in items)))
+            else:
+                raw = _stable_repr(key(*args, **kwargs))
+            return '%s:%s' % (name, hashlib.sha1(raw.encode('utf-8')).hexdigest())
+
+        def store(redis_key, result):
+            try:
+                client.set(redis_key, serializer.dumps(result), ex=ttl)
+            except Exception as e:
+                logger.warning('tiered cache set %s error %s' % (redis_key, e))
+
+        def load(cache_key, args, kwargs):
+            result = l1.peek(cache_key, _MISSING)
+            if result is not _MISSING:
+                return result
+            started = time.perf_counter()
+            redis_key = remote_key(args, kwargs)
+            try:
+                raw = client.get(redis_key)
+            except Exception as e:
+                logger.warning('tiered cache get %s error %s' % (redis_key, e))
+                raw = None
+            if raw is not None:
+                result = serializer.loads(raw)
+            else:
+                result = obj(*args, **kwargs)
+                store(redis_key, result)
+            l1.set(cache_key, result)
+            l1.record_load(time.perf_counter() - started)
+            return result
+
+        @functools.wraps(obj)
+        def memoizer(*args, **kwargs):
+            cache_key = local_key(args, kwargs)
+            result = l1.get(cache_key, _MISSING)
+            if result is not _MISSING:
+                return result
+            if flight is not None:
+                return flight.do(cache_key, load, cache_key, args, kwargs)
+            return load(cache_key, args, kwargs)
+
+        def get_many(arg_tuples):
+            results = []
+            missing = []
+            for args in arg_tuples:
+                cache_key = local_key(args, {})
+                result = l1.get(cache_key, _MISSING)
+                if result is _MISSING:
+                    missing.append((len(results), args, cache_key, remote_key(args, {})))
+                results.append(result)
+            if not missing:
+                return results
+            started = time.perf_counter()
+            try:
+                pipe = client.pipeline(transaction=False)
+                for _, _, _, redis_key in missing:
+                    pipe.get(redis_key)
+                raws = pipe.execute()
+            except Exception as e:
+                logger.warning('tiered cache multi-get error %s' % e)
+                raws = [None] * len(missing)
+            computed = []
+            for (index, args, cache_key, redis_key), raw in zip(missing, raws):
+                if raw is not None:
+                    result = serializer.loads(raw)
+                else:
+                    result = obj(*args)
+                    computed.append((redis_key, result))
+                l1.set(cache_key, result)
+                results[index] = result
+            if computed:
+                try:
+                    pipe = client.pipeline(transaction=False)
+                    for redis_key, result in computed:
+                        pipe.set(redis_key, serializer.dumps(result), ex=ttl)
+                    pipe.execute()
+                except Exception as e:
+                    logger.warning('tiered cache multi-set error %s' % e)
+            l1.record_load(time.perf_counter() - started)
+            return results
+
+        def invalidate(*args, **kwargs):
+            l1.delete(local_key(args, kwargs))
+            try:
+                client.delete(remote_key(args, kwargs))
+            except Exception as e:
+                logger.warning('tiered cache delete error %s' % e)
+
+        memoizer.cache = l1
+        memoizer.cache_info = l1.info
+        memoizer.cache_clear = l1.clear
+        memoizer.get_many = get_many
+        memoizer.invalidate = invalidate
+        return memoizer
+    return decorator
+
+
+if __name__ == '__main__':
+    import timeit
+
+    def dict_memoize(obj):
+        cache = {}
+
+        @functools.wraps(obj)
+        def memoizer(*args, **kwargs):
+            key = str(args) + str(kwargs)
+            if key not in cache:
+                cache[key] = obj(*args, **kwargs)
+            return cache[key]
+        return memoizer
+
+    def square(x):
+        return x * x
+
+    lru_square = memoize(maxsize=1024)(square)
+    dict_square = dict_memoize(square)
+    for i in range(1000):
+        lru_square(i)
+        dict_square(i)
+
+    number = 200000
+    for label, stmt in (('dict memoize', 'dict_square(500)'),
+                        ('lru memoize', 'lru_square(500)')):
+        cost = timeit.timeit(stmt, globals=globals(), number=number)
+        print('%-14s hit %.1f ns/call' % (label, cost / number * 1e9))
+    print(lru_square.cache_info())
+
+    # per-instance memory: slotted vs dict-based cached properties
+    import tracemalloc
+
+    class DictRecord(object):
+        def __init__(self, x):
+            self.x = x
+
+        @CacheProperty
+        def double(self):
+            return self.x * 2
+
+    class SlotRecord(object):
+        __slots__ = ('x', '_cached_double')
+
+        def __init__(self, x):
+            self.x = x
+
+        @SlotCacheProperty
+        def double(self):
+            return self.x * 2
+
+    print('')
+    for record_cls in (DictRecord, SlotRecord):
+        tracemalloc.start()
+        records = [record_cls(i) for i in range(100000)]
+        for record in records:
+            record.double
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del records
+        print('%-10s %.1f bytes/instance' % (record_cls.__name__, size / 100000))
+
+    # key construction: old str keys vs hashed tuple keys
+    samples = {
+        'small': ((1, 'a'), {'b': 2.5}),
+        'large': ((tuple(range(10000)),), {}),
+        'nested': ((((1, 2), ('x', (3, 4))), frozenset({'a', 'b'})), {'flag': True}),
+    }
+    print('')
+    for label, (args, kwargs) in samples.items():
+        str_cost = timeit.timeit(lambda: str(args) + str(kwargs), number=10000)
+        tuple_cost = timeit.timeit(lambda: hash(make_key(args, kwargs)), number=10000)
+        print('%-7s str key %9.1f ns   hashed key %9.1f ns' % (
+            label, str_cost / 10000 * 1e9, tuple_cost / 10000 * 1e9))
@@ -0,0 +1,242 @@
+"""
+GET响应缓存
+    遵循 Cache-Control max-age/no-cache/no-store,
+    过期后带 If-None-Match/If-Modified-Since 重新验证, 304时复用缓存内容
+    按字节数限制大小, 内存(MemoryBackend)或磁盘(DiskBackend, sqlite)
+
+    client = APIClient(base_url, response_cache=ResponseCache(max_bytes=64 * 1024 * 1024))
+"""
+import os
+import re
+import time
+import pickle
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+_MAX_AGE_RE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)"?', re.I)
+# request headers that are part of the cache key, so callers with other
+# credentials or formats never get each other's bodies
+KEY_HEADERS = ('accept', 'accept-language', 'authorization', 'cookie')
+# bodies are cached decoded, the transfer encoding does not matter
+_VARY_IGNORED = ('accept-encoding',)
+
+
+class CacheEntry(object):
+    __slots__ = ('body', 'content_type', 'etag', 'last_modified', 'expires_at')
+
+    def __init__(self, body, content_type, etag, last_modified, expires_at):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    @property
+    def size(self):
+        # body plus a rough allowance for the headers and bookkeeping
+        return len(self.body) + 256
+
+    def fresh(self):
+        return self.expires_at > time.time()
+
+    def validators(self):
+        """ Headers for a conditional GET revalidating this entry """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class MemoryBackend(object):
+    """ In-process LRU holding at most ``max_bytes`` of entries """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.size
+            self._data[key] = entry
+            self.current_bytes += entry.size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.current_bytes -= evicted.size
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.size
+
+
+class DiskBackend(object):
+    """
+    sqlite file holding at most ``max_bytes`` of entries, least recently used go first.
+
+    A hit refreshes the entry's recency at most once every ``touch_interval``
+    seconds, so hot keys do not write on every lookup. The connection is
+    opened on first use and again in every forked child.
+    """
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, touch_interval=60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self._conn = self._inherited = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        """ This process's connection, call with self._lock held """
+        if self._pid != os.getpid():
+            # keep a connection inherited from the parent referenced and unused
+            self._inherited = self._conn
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS http_cache '
+                                   '(key TEXT PRIMARY KEY, entry BLOB, size INTEGER, used REAL)')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS http_cache_used ON http_cache (used)')
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            conn = self.conn
+            row = conn.execute('SELECT entry, used FROM http_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] >= self.touch_interval:
+                with conn:
+                    conn.execute('UPDATE http_cache SET used = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            conn = self.conn
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?)',
+                             (key, pickle.dumps(entry, protocol=4), entry.size, time.time()))
+                total = conn.execute('SELECT TOTAL(size) FROM http_cache').fetchone()[0]
+                while total > self.max_bytes:
+                    row = conn.execute('SELECT key, size FROM http_cache ORDER BY used LIMIT 1').fetchone()
+                    conn.execute('DELETE FROM http_cache WHERE key = ?', (row[0],))
+                    total -= row[1]
+
+    def delete(self, key):
+        with self._lock:
+            conn = self.conn
+            with conn:
+                conn.execute('DELETE FROM http_cache WHERE key = ?', (key,))
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._conn.close()
+            self._conn = self._pid = None
+
+
+class ResponseCache(object):
+    """
+    Cache of GET response bodies following the upstream's caching headers.
+
+    Entries are keyed on the url, the query and the request's KEY_HEADERS
+    (a Vary on other headers is not cached), and kept for Cache-Control ``max-age`` seconds (``default_ttl``
+    when the upstream sends validators but no max-age), then revalidated.
+    ``no-store`` responses, and responses neither fresh nor revalidatable,
+    are not kept.
+    """
+    def __init__(self, backend=None, max_bytes=64 * 1024 * 1024, default_ttl=0):
+        self.backend = backend or MemoryBackend(max_bytes)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url, params=None, headers=None):
+        key = url
+        if params:
+            key = '%s?%s' % (url, urlencode(sorted(params.items()), doseq=True))
+        if headers:
+            values = {name.lower(): value for name, value in headers.items()}
+            varies = [(name, values[name]) for name in KEY_HEADERS if name in values]
+            if varies:
+                # hashed so that credentials are not kept in the key
+                key += '#' + hashlib.sha1(repr(varies).encode('utf-8')).hexdigest()
+        return key
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        elif entry.fresh():
+            self.hits += 1
+        return entry
+
+    def store(self, key, response):
+        """ Keep a 200 response if its headers allow it """
+        headers = response.headers
+        cache_control = headers.get('Cache-Control', '')
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return
+        # the key only tells KEY_HEADERS apart, Vary on anything else (or *) is not cached
+        vary = headers.get('Vary', '')
+        if vary and any(name.strip().lower() not in KEY_HEADERS + _VARY_IGNORED
+                        for name in vary.split(',')):
+            return
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        ttl = self._ttl(cache_control)
+        if ttl <= 0 and not etag and not last_modified:
+            return
+        entry = CacheEntry(response.content, headers.get('Content-Type', ''),
+                           etag, last_modified, time.time() + ttl)
+        self.backend.set(key, entry)
+
+    def refresh(self, key, entry, response):
+        """ 304: the cached body is still valid, renew its lifetime """
+        self.revalidated += 1
+        headers = response.headers
+        entry.etag = headers.get('ETag') or entry.etag
+        entry.last_modified = headers.get('Last-Modified') or entry.last_modified
+        entry.expires_at = time.time() + self._ttl(headers.get('Cache-Control', ''))
+        self.backend.set(key, entry)
+
+    def _ttl(self, cache_control):
+        if 'no-cache' in cache_control:
+            return 0
+        match = _MAX_AGE_RE.search(cache_control)
+        if match:
+            return int(match.group(1))
+        return self.default_ttl
+
+    def info(self):
+        return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses}
@@ -0,0 +1,69 @@
+"""
+对数分桶直方图
+    每个桶覆盖 [MIN_VALUE*BASE**i, MIN_VALUE*BASE**(i+1)) 秒, 宽度 BASE-1 (~19%),
+    百分位取桶的几何中点, 相对误差不超过 sqrt(BASE)-1 (~9%)
+    只保存非空桶, 内存小, 可合并(多线程/多进程汇总)
+"""
+import math
+
+# 4 buckets per doubling
+BASE = 2 ** 0.25
+_LOG_BASE = math.log(BASE)
+# values below MIN_VALUE (1 microsecond) all land in the lowest bucket
+MIN_VALUE = 1e-6
+
+
+class LogHistogram(object):
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value > MIN_VALUE:
+            index = int(math.log(value / MIN_VALUE) / _LOG_BASE)
+        else:
+            index = 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """ Geometric midpoint of the bucket holding the q-th percentile (0-100) """
+        if not self.count:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.max, MIN_VALUE * BASE ** (index + 0.5))
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
@@ -0,0 +1,133 @@
+"""
+patch_module / patch_class 插桩开销
+    同一个函数分别在 未插桩 / 插桩 / 嵌套插桩 / verbose 下调用,
+    输出每次调用的耗时和相对未插桩的额外开销(ns)
+
+    python -m profile.perf_bench
+    python -m profile.perf_bench --number 500000
+    python -m profile.perf_bench --sampler      # 采样分析对CPU密集代码的减速
+"""
+import types
+import timeit
+import argparse
+import threading
+import functools
+from collections import Counter
+
+from profile.perftimer import PerfTimer, patch_module, patch_class
+from profile.sampler import Sampler
+
+
+def _make_module():
+    module = types.ModuleType('bench_target')
+
+    def add(a, b):
+        return a + b
+
+    def call_add(a, b):
+        return module.add(a, b)
+
+    add.__module__ = call_add.__module__ = module.__name__
+    module.add = add
+    module.call_add = call_add
+    return module
+
+
+class Target(object):
+    def add(self, a, b):
+        return a + b
+
+
+def _legacy_logging_perf(func, fullname, category):
+    """ The time.time() / Counter.update wrapper this module replaced, for comparison """
+    import time
+    context = threading.local()
+    counter = Counter()
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        if not getattr(context, 'lock', False):
+            context.lock = True
+            start_time = time.time()
+            result = func(*args, **kwargs)
+            time_spent = time.time() - start_time
+            counter.update({(fullname, category): time_spent})
+            context.lock = False
+            return result
+        return func(*args, **kwargs)
+    return wrapped
+
+
+def per_call_ns(stmt, number, repeat=5):
+    """ Best of ``repeat`` runs, ns per call """
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number * 1e9
+
+
+def run(number=200000):
+    timer = PerfTimer.get_instance()
+    timer.re_init('perf_bench')
+
+    plain = _make_module()
+    patched = _make_module()
+    patch_module(patched, 'bench', methods=['add'])
+    nested = _make_module()
+    patch_module(nested, 'bench', methods=['call_add', 'add'])
+
+    class Patched(Target):
+        pass
+    patch_class(Patched, 'bench', methods=['add'])
+    obj, patched_obj = Target(), Patched()
+
+    legacy = _legacy_logging_perf(plain.add, 'bench_target.add', 'bench')
+
+    base = per_call_ns(lambda: plain.add(1, 2), number)
+    method_base = per_call_ns(lambda: obj.add(1, 2), number)
+    rows = [
+        ('function, unpatched', base, base),
+        ('function, patch_module', per_call_ns(lambda: patched.add(1, 2), number), base),
+        ('function, legacy time.time wrapper', per_call_ns(lambda: legacy(1, 2), number), base),
+        ('method, unpatched', method_base, method_base),
+        ('method, patch_class', per_call_ns(lambda: patched_obj.add(1, 2), number), method_base),
+        # both levels timed, add recorded under call_add in the call tree
+        ('nested, both timed', per_call_ns(lambda: nested.call_add(1, 2), number),
+         per_call_ns(lambda: plain.call_add(1, 2), number)),
+    ]
+    timer.re_init('perf_bench', verbose=True)
+    rows.append(('function, patch_module verbose',
+                 per_call_ns(lambda: patched.add(1, 2), number // 10), base))
+    timer.re_init('perf_bench')
+
+    print('%-36s %10s %10s' % ('CASE', 'NS/CALL', 'OVERHEAD'))
+    for label, ns, reference in rows:
+        print('%-36s %10.1f %10.1f' % (label, ns, ns - reference))
+
+
+def _busy(n=200000):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def run_sampler(intervals=(0.001, 0.01, 0.1), repeat=5):
+    """ Slowdown of a CPU bound loop while a Sampler runs next to it """
+    timeit.repeat(_busy, number=10, repeat=repeat)
+    base = min(timeit.repeat(_busy, number=10, repeat=repeat))
+    print('%-16s %10s %10s %12s' % ('INTERVAL', 'SECONDS', 'SLOWDOWN', 'SAMPLER CPU'))
+    print('%-16s %10.4f %9.2f%% %12s' % ('off', base, 0.0, '-'))
+    for interval in intervals:
+        with Sampler(interval) as sampler:
+            seconds = min(timeit.repeat(_busy, number=10, repeat=repeat))
+        print('%-16s %10.4f %9.2f%% %11.4fs' % (interval, seconds, (seconds / base - 1) * 100,
+                                                sampler.sampler_cpu))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per call overhead of perftimer instrumentation')
+    parser.add_argument('--number', type=int, default=200000, help='calls per measurement')
+    parser.add_argument('--sampler', action='store_true', help='measure the sampling profiler instead')
+    args = parser.parse_args()
+    if args.sampler:
+        run_sampler()
+    else:
+        run(args.number)
@@ -1,70 +1,249 @@
 """
 profile性能分析工具包
-    使用time模块在执行以后计算耗时
+    使用单调纳秒时钟(perf_counter_ns)计算耗时,
+    当前PerfTimer和调用树节点保存在contextvars中, 每个asyncio task/请求互不干扰,
+    profiling() 为代码块创建独立的PerfTimer, 不在其中的线程使用各自默认的PerfTimer,
+    propagate()/PerfExecutor 把线程池中执行的任务合并回提交者的调用树,
+    按调用路径记录调用树(调用次数, 总耗时, 自身耗时),
+    嵌套调用(如model方法中的redis调用)不再丢失,
+    verbose关闭时每次调用只更新已有的节点, 可以在生产环境常开
+    每个调用路径一个对数分桶直方图(profile.histogram), 可合并
+    report() 输出分类/函数汇总(次数, 平均, p50/p95/p99, 最大)和调用树,
+    folded() 导出flamegraph折叠栈
 
 使用场景
     1.分析model中方法耗时
     2.分析class中的方法耗时
 """
 import types
+import inspect
 import functools
 import logging
 import sys
-import time
-from threading import local
+from time import perf_counter_ns
+from threading import local, get_ident
 from contextlib import contextmanager
-from collections import Counter
-
-import redis
-import requests
+from collections import Counter, deque
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 
 from tabulate import tabulate
 
-_local_context = local()
+from profile.histogram import LogHistogram
+
+
+class _Node(object):
+    """
+    One call path in the call tree: ``key`` (name, category) called from
+    the parent node's path. total_ns is inclusive, child_ns the part of it
+    spent in timed callees, hist the latency of each call in seconds.
+    """
+    __slots__ = ('key', 'timer', 'children', 'total_ns', 'child_ns', 'hist')
+
+    def __init__(self, key, timer):
+        self.key = key
+        self.timer = timer
+        self.children = {}
+        self.total_ns = 0
+        self.child_ns = 0
+        self.hist = LogHistogram()
+
+    def child(self, key):
+        node = self.children.get(key)
+        if node is None:
+            node = self.children[key] = _Node(key, self.timer)
+        return node
+
+    def merge(self, other):
+        """ Add the subtrees under ``other`` (another timer's node) below this node """
+        for key, src in other.children.items():
+            node = self.child(key)
+            node.total_ns += src.total_ns
+            node.child_ns += src.child_ns
+            node.hist.merge(src.hist)
+            node.merge(src)
+
+    @property
+    def count(self):
+        return self.hist.count
+
+    @property
+    def self_ns(self):
+        # log_time() durations may overlap timed callees, never go negative
+        return max(0, self.total_ns - self.child_ns)
+
+
+_LATENCY_HEADERS = ["CALLS", "MEAN(ms)", "P50(ms)", "P95(ms)", "P99(ms)", "MAX(ms)"]
+
+
+def _latency_columns(hist):
+    summary = hist.summary()
+    return (summary['count'],) + tuple(round(summary[name] * 1000, 3)
+                                       for name in ('mean', 'p50', 'p95', 'p99', 'max'))
 
 
 class PerfTimer(object):
     def __init__(self, profiler_name='', verbose=False):
-        self.profiler_name = profiler_name
-        self.verbose = verbose
-        self.call_logs = []
-        self.time_spent = Counter()
-        self.lock = False
-        self.logger = logging.getLogger('PerfTimer')
+        self.re_init(profiler_name, verbose)
 
     def re_init(self, profiler_name, verbose=False):
         self.profiler_name = profiler_name
         self.verbose = verbose
         self.call_logs = []
-        self.time_spent = Counter()
-        self.lock = False
+        if getattr(self, 'root', None) is None:
+            self.root = _Node(None, self)
+        else:
+            # reset in place, scopes of this thread keep pointing at the root
+            self.root.__init__(None, self)
+        # made by profiling(): executor work is merged back into it
+        self.scoped = False
+        # (node, PerfTimer) of executor work, folded in by the owning thread
+        self._pending = deque()
         self.logger = logging.getLogger('PerfTimer')
 
+    def sub_timer(self, node):
+        """ A PerfTimer for work on another thread, merged below ``node`` when this one reports """
+        perf_timer = PerfTimer(self.profiler_name, self.verbose)
+        perf_timer.scoped = True
+        self._pending.append((node, perf_timer))
+        return perf_timer
+
     def log_time(self, item_name, category, time_spent, args, kwargs):
-        self.time_spent.update({(item_name, category): time_spent})
+        """ Record ``time_spent`` seconds, for callers timing on their own """
+        self.record((item_name, category), int(time_spent * 1e9), args, kwargs)
+
+    def record(self, key, elapsed_ns, args=(), kwargs=None):
+        """ A finished call of ``key`` under the call being timed now """
+        scope = _scope.get()
+        if scope is not None and scope.timer is self and scope.thread_id == get_ident():
+            current = scope.node
+        else:
+            current = self.root
+        node = current.child(key)
+        node.total_ns += elapsed_ns
+        node.hist.add(elapsed_ns / 1e9)
+        current.child_ns += elapsed_ns
         if self.verbose:
             self.call_logs.append({
-                'name': item_name,
-                'time': time_spent,
+                'name': key[0],
+                'time': elapsed_ns / 1e9,
                 'args': args,
-                'kwargs': kwargs
+                'kwargs': kwargs or {}
                 })
 
-    def report(self):
+    def merge_pending(self):
+        """
+        Fold in the work done on executor threads. Work still running is
+        merged as far as it got, later calls of it are not counted.
+        """
+        while self._pending:
+            node, timer = self._pending.popleft()
+            timer.merge_pending()
+            node.merge(timer.root)
+            node.child_ns += timer.root.child_ns
+            self.call_logs.extend(timer.call_logs)
+
+    def stats(self):
+        """
+        {(name, category): [total_ns, self_ns, LogHistogram]} over the whole
+        tree, the histograms of every path merged. Recursive calls are
+        counted once in total_ns.
+        """
+        self.merge_pending()
+        result = {}
+
+        def walk(node, active):
+            for key, child in node.children.items():
+                row = result.get(key)
+                if row is None:
+                    row = result[key] = [0, 0, LogHistogram()]
+                if key not in active:
+                    row[0] += child.total_ns
+                row[1] += child.self_ns
+                row[2].merge(child.hist)
+                walk(child, active | {key})
+        walk(self.root, frozenset())
+        return result
+
+    @property
+    def time_spent(self):
+        """ Seconds spent per (name, category), callees included """
+        return Counter({key: row[0] / 1e9 for key, row in self.stats().items()})
+
+    def folded(self):
+        """
+        Self time per call path in the folded stack format of flamegraph.pl
+        and speedscope: ``outer;inner 1234``, counts in microseconds
+        """
+        self.merge_pending()
+        lines = []
+
+        def walk(node, path):
+            for child in node.children.values():
+                child_path = path + (child.key[0],)
+                if child.self_ns >= 1000:
+                    lines.append('{} {}'.format(';'.join(child_path), child.self_ns // 1000))
+                walk(child, child_path)
+        walk(self.root, ())
+        return lines
+
+    def dump_folded(self, path):
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.folded()))
+            f.write('\n')
+
+    def tree(self, max_depth=None, min_percent=0.5):
+        """
+        The call tree as text lines, heaviest first. Nodes under
+        ``min_percent`` of the profiled time and anything below
+        ``max_depth`` are collapsed into their parent's line.
+        """
+        self.merge_pending()
+        total = self.root.child_ns or 1
+        lines = ['{:>10} {:>10} {:>8} {:>6}  {}'.format('TOTAL', 'SELF', 'CALLS', '%', 'CALL TREE')]
+
+        def walk(node, depth):
+            hidden = 0
+            for child in sorted(node.children.values(), key=lambda n: n.total_ns, reverse=True):
+                if child.total_ns * 100.0 / total < min_percent:
+                    hidden += 1
+                    continue
+                collapsed = max_depth is not None and depth + 1 >= max_depth and child.children
+                lines.append('{:>10.4f} {:>10.4f} {:>8} {:>5.1f}%  {}{} [{}]{}'.format(
+                    child.total_ns / 1e9, child.self_ns / 1e9, child.count,
+                    child.total_ns * 100.0 / total, '  ' * depth, child.key[0], child.key[1],
+                    ' (+{})'.format(len(child.children)) if collapsed else ''))
+                if not collapsed:
+                    walk(child, depth + 1)
+            if hidden:
+                lines.append('{:>10} {:>10} {:>8} {:>6}  {}... {} more'.format(
+                    '', '', '', '', '  ' * depth, hidden))
+        walk(self.root, 0)
+        return lines
+
+    def report(self, max_depth=None, min_percent=0.5):
         result = ['Performance stats for {}'.format(self.profiler_name)]
-        # sorted time by category
+        stats = self.stats()
+        # sorted self time by category, so categories add up to the total
         category_time = Counter()
-        for key, time_spent in self.time_spent.items():
-            category_time.update({key[1]: time_spent})
-        rows = [(k[1], v) for k, v in self.time_spent.items()]
+        category_hist = {}
+        for key, row in stats.items():
+            category_time[key[1]] += row[1] / 1e9
+            category_hist.setdefault(key[1], LogHistogram()).merge(row[2])
+        rows = [(category, time_spent) + _latency_columns(category_hist[category])
+                for category, time_spent in category_time.items()]
         rows.sort(key=lambda x: x[1], reverse=True)
-        result.append(tabulate(rows, headers=["CATEGROY", "TIME"]))
+        result.append(tabulate(rows, headers=["CATEGROY", "SELF"] + _LATENCY_HEADERS))
 
         # sorted time by func calls
         result.append('')
-        rows = [(k[0], v) for k, v in self.time_spent.items()]
+        rows = [(k[0], row[0] / 1e9, row[1] / 1e9) + _latency_columns(row[2])
+                for k, row in stats.items()]
         rows.sort(key=lambda x: x[1], reverse=True)
-        result.append(tabulate(rows, headers=["CALL", "TIME"]))
+        result.append(tabulate(rows, headers=["CALL", "TOTAL", "SELF"] + _LATENCY_HEADERS))
+
+        result.append('')
+        result.extend(self.tree(max_depth, min_percent))
 
         # individual calls
         if self.verbose:
@@ -74,27 +253,107 @@ class PerfTimer(object):
                               '[args={args} kwargs={kwargs}]'.format(**log))
         self.logger.info('\n'.join(result))
 
-    def acquire_lock(self):
-        """ Acquire the lock
-        A function should only be timed if none of its caller is timed.
-        Otherwise, there will be double-count. Acquire a lock before timing
-        ensures that condition.
-        """
-        if not self.lock:
-            self.lock = True
-            return True
-        return False
-
-    def unlock(self):
-        """ Release the lock """
-        self.lock = False
-
     @classmethod
     def get_instance(cls):
-        """ There should be only one PerfTimer instance per-thread """
-        if not hasattr(_local_context, 'perf_timer'):
-            _local_context.perf_timer = PerfTimer()
-        return _local_context.perf_timer
+        """ The timer of the current profiling() scope, else the thread's own """
+        return _current_scope().timer
+
+
+class _Context(local):
+    # runs once per thread on first access, so lookups need no hasattr check
+    def __init__(self):
+        self.perf_timer = PerfTimer()
+
+
+_local_context = _Context()
+
+
+class _Scope(object):
+    """
+    Where the running code records: a timer, the call being timed in it,
+    and the one thread allowed to write to that timer's tree.
+
+    Sync calls move ``node`` down and back up in place, no allocation;
+    they run to completion, so tasks sharing a scope never see each
+    other's half. A timed coroutine gets a scope of its own (its node
+    stays current across awaits), so does a context copied to another
+    thread (asyncio.to_thread), which then records into a sub-timer.
+    """
+    __slots__ = ('timer', 'node', 'thread_id')
+
+    def __init__(self, timer, node):
+        self.timer = timer
+        self.node = node
+        self.thread_id = get_ident()
+
+
+# asyncio tasks copy the context on creation
+_scope = ContextVar('perf_timer_scope', default=None)
+
+
+def _current_scope():
+    scope = _scope.get()
+    if scope is None or scope.thread_id != get_ident():
+        scope = _new_scope(scope)
+    return scope
+
+
+def _new_scope(foreign):
+    if foreign is not None and foreign.timer.scoped:
+        # the context came from another thread inside profiling(): record
+        # apart and merge below the call that handed the work over
+        perf_timer = foreign.timer.sub_timer(foreign.node)
+    else:
+        perf_timer = _local_context.perf_timer
+    scope = _Scope(perf_timer, perf_timer.root)
+    _scope.set(scope)
+    return scope
+
+
+def _leave_verbose(node, elapsed, args, kwargs):
+    node.timer.call_logs.append({
+        'name': node.key[0],
+        'time': elapsed / 1e9,
+        'args': args,
+        'kwargs': kwargs
+        })
+
+
+def propagate(func):
+    """
+    ``func`` wrapped to run on another thread (executor.submit,
+    loop.run_in_executor) with its timed calls profiled in a PerfTimer of
+    its own, merged below the caller's current call when the caller's
+    timer reports. Parallel work can add up to more than the caller's
+    wall time, its self time then shows as 0.
+    Outside profiling() ``func`` is returned as is, it records into the
+    worker thread's own timer.
+    """
+    scope = _current_scope()
+    if not scope.timer.scoped:
+        return func
+    owner, parent = scope.timer, scope.node
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        perf_timer = PerfTimer(owner.profiler_name, owner.verbose)
+        perf_timer.scoped = True
+        token = _scope.set(_Scope(perf_timer, perf_timer.root))
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _scope.reset(token)
+            owner._pending.append((parent, perf_timer))
+    return run
+
+
+class PerfExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor profiling its tasks into the submitter's call tree,
+    also as the executor of loop.run_in_executor
+    """
+    def submit(self, fn, *args, **kwargs):
+        return super(PerfExecutor, self).submit(propagate(fn), *args, **kwargs)
 
 
 def patch_module(module, category, methods=None):
@@ -124,31 +383,76 @@ def patch_class(cls, category, methods=None):
 
 
 def logging_perf(func, fullname, category):
+    key = (fullname, category)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapped(*args, **kwargs):
+            # wall time from call to result, time suspended included
+            outer = _current_scope()
+            parent = outer.node
+            node = parent.child(key)
+            token = _scope.set(_Scope(outer.timer, node))
+            start = perf_counter_ns()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter_ns() - start
+                _scope.reset(token)
+                node.total_ns += elapsed
+                node.hist.add(elapsed / 1e9)
+                parent.child_ns += elapsed
+                if node.timer.verbose:
+                    _leave_verbose(node, elapsed, args, kwargs)
+        return async_wrapped
+
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
-        perf_timer = PerfTimer.get_instance()
-        if perf_timer.acquire_lock():
-            start_time = time.time()
-            result = func(*args, **kwargs)
-            time_spent = time.time() - start_time
-            perf_timer.log_time(
-                fullname, category, time_spent, args, kwargs)
-            perf_timer.unlock()
-            return result
-        else:
+        scope = _scope.get()
+        if scope is None or scope.thread_id != get_ident():
+            scope = _new_scope(scope)
+        parent = scope.node
+        node = parent.children.get(key)
+        if node is None:
+            node = parent.child(key)
+        scope.node = node
+        start = perf_counter_ns()
+        try:
             return func(*args, **kwargs)
+        finally:
+            elapsed = perf_counter_ns() - start
+            scope.node = parent
+            node.total_ns += elapsed
+            node.hist.add(elapsed / 1e9)
+            parent.child_ns += elapsed
+            if node.timer.verbose:
+                _leave_verbose(node, elapsed, args, kwargs)
     return wrapped
 
 
 @contextmanager
-def profiling(profiler_name, verbose):
-    perf_timer = PerfTimer.get_instance()
-    perf_timer.re_init(profiler_name, verbose)
-    yield
+def profiling(profiler_name, verbose, folded_path=None):
+    """
+    Profile the block with a new PerfTimer, scoped to the current context:
+    in a coroutine only that task (and tasks it creates) record into it.
+    folded_path: also write the folded stacks there, for flamegraph.pl
+    """
+    perf_timer = PerfTimer(profiler_name, verbose)
+    perf_timer.scoped = True
+    token = _scope.set(_Scope(perf_timer, perf_timer.root))
+    try:
+        yield perf_timer
+    finally:
+        _scope.reset(token)
     perf_timer.report()
+    if folded_path:
+        perf_timer.dump_folded(folded_path)
 
 
 if __name__ == '__main__':
+    import redis
+    import requests
+
     logging.basicConfig(
         stream=sys.stdout,
         level=logging.INFO,
@@ -0,0 +1,175 @@
+"""
+采样分析
+    后台线程每隔interval秒读取一次 sys._current_frames(), 按线程累计调用栈,
+    不需要patch任何函数, 开销只与采样频率和线程数有关,
+    可以在一小部分worker上常开
+
+    with sampling('job', interval=0.01, top=20, folded_path='/tmp/job.folded'):
+        run_job()
+
+    sampler = start_sampler(fraction=0.05)   # 5%的进程常开, 其余返回None
+    ...
+    sampler.dump_folded(path); sampler.reset()
+"""
+import os
+import sys
+import random
+import logging
+import threading
+from time import perf_counter, thread_time
+from contextlib import contextmanager
+from collections import Counter
+
+from tabulate import tabulate
+
+
+def _label(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Sampler(object):
+    """
+    Stack sampler for the threads of this process.
+
+    Stacks are kept as tuples of code objects, outermost first, counted
+    per thread; labels are only built when reporting. ``max_depth`` keeps
+    the innermost frames of very deep stacks.
+    """
+    def __init__(self, interval=0.01, max_depth=64, name=''):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.name = name
+        self.logger = logging.getLogger('Sampler')
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stacks = {}
+            self.thread_names = {}
+            self.samples = 0
+            self.sampler_cpu = 0.0
+            self.started_at = perf_counter()
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='Sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return self
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            cpu = thread_time()
+            self.sample(own)
+            self.sampler_cpu += thread_time() - cpu
+
+    def sample(self, skip=None):
+        """ Record the current stack of every thread but ``skip`` """
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, frame in frames.items():
+                if ident == skip:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                counter = self.stacks.get(ident)
+                if counter is None:
+                    counter = self.stacks[ident] = Counter()
+                    self.thread_names[ident] = self._thread_name(ident)
+                counter[tuple(stack)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def _thread_name(ident):
+        for thread in threading.enumerate():
+            if thread.ident == ident:
+                return thread.name
+        return str(ident)
+
+    def top(self, n=20):
+        """
+        [(label, self samples, total samples)] of the n functions with the
+        most samples on top of the stack; total counts a function once per
+        sample however deep it recurses
+        """
+        own = Counter()
+        total = Counter()
+        with self._lock:
+            for counter in self.stacks.values():
+                for stack, count in counter.items():
+                    if not stack:
+                        continue
+                    own[stack[-1]] += count
+                    for code in set(stack):
+                        total[code] += count
+        return [(_label(code), count, total[code]) for code, count in own.most_common(n)]
+
+    def folded(self, per_thread=True):
+        """ ``thread;outer;inner count`` lines for flamegraph.pl and speedscope """
+        merged = Counter()
+        with self._lock:
+            for ident, counter in self.stacks.items():
+                prefix = (self.thread_names[ident],) if per_thread else ()
+                for stack, count in counter.items():
+                    merged[prefix + tuple(_label(code) for code in stack)] += count
+        return ['{} {}'.format(';'.join(stack), count) for stack, count in merged.items()]
+
+    def dump_folded(self, path, per_thread=True):
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.folded(per_thread)))
+            f.write('\n')
+
+    def report(self, top=20):
+        elapsed = perf_counter() - self.started_at
+        result = ['Sampling stats for {}: {} samples every {}s over {:.2f}s, '
+                  'sampler cpu {:.4f}s ({:.2f}%)'.format(
+                      self.name, self.samples, self.interval, elapsed, self.sampler_cpu,
+                      self.sampler_cpu * 100.0 / elapsed if elapsed else 0.0)]
+        samples = sum(sum(counter.values()) for counter in self.stacks.values()) or 1
+        rows = [(label, own, round(own * 100.0 / samples, 2), total, round(total * 100.0 / samples, 2))
+                for label, own, total in self.top(top)]
+        result.append(tabulate(rows, headers=["FUNCTION", "SELF", "SELF%", "TOTAL", "TOTAL%"]))
+        self.logger.info('\n'.join(result))
+
+
+def start_sampler(fraction=1.0, interval=0.01, max_depth=64, name=''):
+    """
+    Start a Sampler in this process with probability ``fraction``, so it can
+    run continuously on a share of the workers; None when not picked
+    """
+    if random.random() >= fraction:
+        return None
+    return Sampler(interval, max_depth, name or str(os.getpid())).start()
+
+
+@contextmanager
+def sampling(profiler_name, interval=0.01, top=20, folded_path=None, max_depth=64):
+    """ Sample the block like profiling() times it, report the top functions at the end """
+    sampler = Sampler(interval, max_depth, profiler_name)
+    with sampler:
+        yield sampler
+    sampler.report(top)
+    if folded_path:
+        sampler.dump_folded(folded_path)
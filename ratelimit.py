@@ -0,0 +1,238 @@
+"""
+令牌桶限流
+    TokenBucket         进程内, 线程安全
+    FileTokenBucket     同一台机器的多个进程共享, 状态存文件, fcntl加锁
+    RedisTokenBucket    多机共享, lua脚本保证原子性
+
+    bucket = TokenBucket(rate=50, capacity=100)
+    bucket.acquire()              # 排队等待令牌, 返回等待的秒数
+    bucket.acquire(timeout=0)     # 没有令牌立即抛出 RateLimitExceeded
+    await bucket.acquire_async()  # asyncio中使用
+"""
+import os
+import time
+import fcntl
+import asyncio
+import struct
+import threading
+
+try:
+    from profile.perftimer import PerfTimer
+except ImportError:
+    PerfTimer = None
+
+
+class RateLimitExceeded(Exception):
+    """ No token within the caller's timeout """
+
+
+class _Bucket(object):
+    """
+    Reservation based token bucket: a caller that has to wait takes its
+    tokens right away (the count may go negative) and sleeps for its turn,
+    so waiters are served in order and nobody spins.
+    Subclasses implement ``_reserve`` on their own storage.
+    """
+    def __init__(self, rate, capacity=None, name=''):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.name = name
+        self.waits = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self, tokens, last, now):
+        if now < last:
+            # clock went backwards (or a stale state file), start over
+            return self.capacity
+        return min(self.capacity, tokens + (now - last) * self.rate)
+
+    def _take(self, tokens, n, max_wait):
+        """ (new token count, wait) for a reservation of n, wait None if refused """
+        if tokens >= n:
+            return tokens - n, 0.0
+        wait = (n - tokens) / self.rate
+        if max_wait is not None and wait > max_wait:
+            return tokens, None
+        return tokens - n, wait
+
+    def _reserve(self, n, max_wait):
+        raise NotImplementedError
+
+    def acquire(self, n=1, timeout=None):
+        """
+        Take ``n`` tokens, waiting at most ``timeout`` seconds (None: as long
+        as needed, 0: fail fast). Returns the seconds waited, raises
+        RateLimitExceeded when the wait would be longer.
+        """
+        wait = self._admit(n, timeout)
+        if wait > 0:
+            time.sleep(wait)
+            self._record_wait(wait)
+        return wait
+
+    async def acquire_async(self, n=1, timeout=None):
+        """ acquire() for coroutines, queues without blocking the loop """
+        wait = self._admit(n, timeout)
+        if wait > 0:
+            await asyncio.sleep(wait)
+            self._record_wait(wait)
+        return wait
+
+    def _admit(self, n, timeout):
+        wait = self._reserve(n, timeout)
+        if wait is None:
+            self.rejected += 1
+            raise RateLimitExceeded('rate limit %s/s exceeded for %s' % (self.rate, self.name))
+        return wait
+
+    def _record_wait(self, wait):
+        self.waits += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+        # queued time shows up as the "ratelimit" category in PerfTimer.report()
+        if PerfTimer is not None:
+            PerfTimer.get_instance().log_time(self.name or 'ratelimit', 'ratelimit', wait, (), {})
+
+    def info(self):
+        return {
+            'name': self.name,
+            'rate': self.rate,
+            'waits': self.waits,
+            'rejected': self.rejected,
+            'total_wait': self.total_wait,
+            'max_wait': self.max_wait,
+        }
+
+
+class TokenBucket(_Bucket):
+    """ Token bucket shared by the threads of one process """
+    def __init__(self, rate, capacity=None, name=''):
+        super(TokenBucket, self).__init__(rate, capacity, name)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, n, max_wait):
+        with self._lock:
+            now = time.monotonic()
+            tokens = self._refill(self.tokens, self.last, now)
+            self.tokens, wait = self._take(tokens, n, max_wait)
+            self.last = now
+            return wait
+
+
+class FileTokenBucket(_Bucket):
+    """
+    Token bucket shared by every process on the box using the same ``path``.
+    The state is two doubles in the file, updated under an exclusive flock.
+    flock belongs to the open file description, which fork() shares, so
+    every process opens the file itself on first use.
+    """
+    _STATE = struct.Struct('dd')
+
+    def __init__(self, path, rate, capacity=None, name=''):
+        super(FileTokenBucket, self).__init__(rate, capacity, name or path)
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    def _file(self):
+        """ This process's fd, call with self._lock held """
+        if self._pid != os.getpid():
+            # an fd inherited from the parent stays open for the parent's sake
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def _reserve(self, n, max_wait):
+        with self._lock:
+            fd = self._file()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                raw = os.pread(fd, self._STATE.size, 0)
+                now = time.time()
+                if len(raw) == self._STATE.size:
+                    tokens = self._refill(*self._STATE.unpack(raw), now=now)
+                else:
+                    tokens = self.capacity
+                tokens, wait = self._take(tokens, n, max_wait)
+                os.pwrite(fd, self._STATE.pack(tokens, now), 0)
+                return wait
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = self._pid = None
+
+
+class RedisTokenBucket(_Bucket):
+    """ Token bucket in redis, shared by every process using the same ``key`` """
+    _SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local n = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(state[1]) or capacity
+local last = tonumber(state[2]) or now
+if now > last then
+    tokens = math.min(capacity, tokens + (now - last) * rate)
+end
+local wait = 0
+if tokens < n then
+    wait = (n - tokens) / rate
+    if max_wait >= 0 and wait > max_wait then
+        return '-1'
+    end
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - n, 'last', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+    def __init__(self, client, key, rate, capacity=None):
+        super(RedisTokenBucket, self).__init__(rate, capacity, key)
+        self.key = key
+        self._script = client.register_script(self._SCRIPT)
+
+    def _reserve(self, n, max_wait):
+        wait = float(self._script(keys=[self.key], args=[
+            self.rate, self.capacity, n, -1 if max_wait is None else max_wait]))
+        return None if wait < 0 else wait
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(name, rate, capacity=None):
+    """
+    The in-process TokenBucket shared by every client of ``name``.
+    Raises ValueError when it already exists with another rate or capacity.
+    """
+    bucket = _buckets.get(name)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(name)
+            if bucket is None:
+                bucket = _buckets[name] = TokenBucket(rate, capacity, name)
+                return bucket
+    if capacity is None:
+        capacity = max(1.0, rate)
+    if (bucket.rate, bucket.capacity) != (float(rate), float(capacity)):
+        raise ValueError('token bucket for %s already exists with rate=%s, capacity=%s, '
+                         'pass a TokenBucket to use another limit' % (name, bucket.rate, bucket.capacity))
+    return bucket
+
+
+def bucket_stats():
+    return [bucket.info() for bucket in list(_buckets.values())]
@@ -0,0 +1,172 @@
+"""
+JSON序列化
+    有orjson时使用orjson, 否则退回标准库json
+    datetime/date/Decimal/UUID 直接支持, datetime格式与 utils.JsonExtendEncoder 一致
+
+    dumps(data)            -> str
+    dumpb(data)            -> bytes, 直接用于网络/文件
+    loads(s)               str/bytes -> object
+    dump(data, fp)         分块写入文件(二进制模式)或socket, 适用于大数据量
+"""
+import json
+import uuid
+import decimal
+import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# bytes buffered before each write in dump()
+CHUNK_SIZE = 64 * 1024
+# list items encoded per call when streaming
+BATCH_SIZE = 512
+
+
+def default(o):
+    """ Serialize the types json does not know about """
+    if isinstance(o, datetime.datetime):
+        if o.tzinfo is None:
+            # same output as strftime(DATETIME_FORMAT), several times faster
+            return o.isoformat(' ', 'seconds')
+        return o.strftime(DATETIME_FORMAT)
+    elif isinstance(o, datetime.date):
+        return o.isoformat()
+    elif isinstance(o, decimal.Decimal):
+        # str keeps the precision a float would lose
+        return str(o)
+    elif isinstance(o, uuid.UUID):
+        return str(o)
+    elif isinstance(o, (set, frozenset)):
+        return list(o)
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+if orjson is not None:
+    # datetimes are passed through so they get the same format as the stdlib
+    # path, iso_datetime=True keeps orjson's native (faster) ISO 8601 output
+    _OPTION = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumpb(data, iso_datetime=False):
+        option = orjson.OPT_NON_STR_KEYS if iso_datetime else _OPTION
+        return orjson.dumps(data, default=default, option=option)
+
+    def dumps(data, iso_datetime=False):
+        return dumpb(data, iso_datetime).decode('utf-8')
+
+    loads = orjson.loads
+else:
+    _encoder = json.JSONEncoder(default=default, ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(data, iso_datetime=False):
+        if iso_datetime:
+            return json.dumps(data, default=_iso_default, ensure_ascii=False, separators=(',', ':'))
+        return _encoder.encode(data)
+
+    def dumpb(data, iso_datetime=False):
+        return dumps(data, iso_datetime).encode('utf-8')
+
+    loads = json.loads
+
+
+def _iso_default(o):
+    if isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    return default(o)
+
+
+def iterencode(data, iso_datetime=False):
+    """
+    Encode ``data`` piece by piece as bytes chunks.
+
+    A top level list/tuple/generator, or the list values of a top level dict
+    (``{"data": [...]}``), are encoded ``BATCH_SIZE`` items at a time, so a
+    big payload is never held as one string.
+    """
+    if isinstance(data, dict):
+        yield b'{'
+        first = True
+        for k, v in data.items():
+            if not first:
+                yield b','
+            first = False
+            yield dumpb(str(k), iso_datetime)
+            yield b':'
+            if _is_sequence(v):
+                yield from _iterencode_items(v, iso_datetime)
+            else:
+                yield dumpb(v, iso_datetime)
+        yield b'}'
+    elif _is_sequence(data):
+        yield from _iterencode_items(data, iso_datetime)
+    else:
+        yield dumpb(data, iso_datetime)
+
+
+def _is_sequence(data):
+    return isinstance(data, (list, tuple)) or hasattr(data, '__next__')
+
+
+def _iterencode_items(items, iso_datetime):
+    yield b'['
+    first = True
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == BATCH_SIZE:
+            if not first:
+                yield b','
+            first = False
+            yield dumpb(batch, iso_datetime)[1:-1]
+            batch = []
+    if batch:
+        if not first:
+            yield b','
+        yield dumpb(batch, iso_datetime)[1:-1]
+    yield b']'
+
+
+def dump(data, fp, iso_datetime=False, chunk_size=CHUNK_SIZE):
+    """
+    Stream ``data`` as JSON into ``fp``, a binary file or anything with
+    ``write``, or a socket (``sendall``). Returns the number of bytes written.
+    """
+    write = getattr(fp, 'sendall', None) or fp.write
+    buf = []
+    size = total = 0
+    for chunk in iterencode(data, iso_datetime):
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            write(b''.join(buf))
+            total += size
+            buf = []
+            size = 0
+    if buf:
+        write(b''.join(buf))
+        total += size
+    return total
+
+
+if __name__ == '__main__':
+    import io
+    import timeit
+    from utils import JsonExtendEncoder
+
+    now = datetime.datetime.now()
+    payload = [{'id': i, 'name': 'user%d' % i, 'created': now, 'day': now.date(),
+                'score': i * 1.5, 'tags': ['a', 'b', 'c']} for i in range(10000)]
+    number = 20
+    print('backend: %s' % ('orjson' if orjson is not None else 'json'))
+    cases = (
+        ('JsonExtendEncoder', lambda: json.dumps(payload, cls=JsonExtendEncoder)),
+        ('serializer.dumps', lambda: dumps(payload)),
+        ('serializer iso', lambda: dumps(payload, iso_datetime=True)),
+        ('serializer.dump', lambda: dump(payload, io.BytesIO())),
+    )
+    for label, func in cases:
+        cost = timeit.timeit(func, number=number) / number
+        print('%-18s %8.2f ms' % (label, cost * 1000))
@@ -0,0 +1,145 @@
+"""
+大响应体流式解析, 内存只与单条记录大小相关
+
+    iter_json_items(chunks, 'data.item')   {"data": [...]} 中逐条返回数组元素
+    iter_json_items(chunks, 'item')        顶层数组逐条返回
+    iter_xml_items(fileobj, 'row')         逐个返回<row>元素, 结构同 xmltodict
+"""
+import re
+import json
+import codecs
+import xml.etree.ElementTree as ET
+
+import xmltodict
+
+_WS = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+_NUMBER_CHARS = frozenset('0123456789.eE+-')
+
+
+class _JsonStream(object):
+    """ Text buffer over an iterable of bytes chunks, refilled on demand """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ Drop the consumed text and append the next chunk, False at the end """
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                self.buf += text
+                return True
+        self.buf += self.decoder.decode(b'', final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """ Next non whitespace character, not consumed """
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('unexpected end of JSON')
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('expected one of %r at %r' % (chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """ Decode the next complete JSON value, reading more input as needed """
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # most likely the value continues in the next chunk
+                if self.fill():
+                    continue
+                raise
+            if self._maybe_cut(obj, end) and self.fill():
+                # a number at the end of the buffer may be cut short
+                continue
+            self.pos = end
+            return obj
+
+    def _maybe_cut(self, obj, end):
+        if end == len(self.buf):
+            return True
+        return isinstance(obj, (int, float)) and self.buf[end] in _NUMBER_CHARS
+
+
+def iter_json_items(chunks, item_path='item'):
+    """
+    Yield the elements of one JSON array as they arrive.
+
+    ``chunks`` is an iterable of bytes (e.g. ``response.iter_content()``).
+    ``item_path`` selects the array like ijson does: ``item`` is the top
+    level array, ``data.item`` the array under the top level key "data".
+    Siblings met on the way to the array are decoded and dropped, the rest
+    of the document after it is not read.
+    """
+    path = item_path.split('.') if item_path else ['item']
+    if path[-1] != 'item' or 'item' in path[:-1]:
+        raise ValueError('item_path must be object keys followed by "item": %s' % item_path)
+    stream = _JsonStream(chunks)
+
+    for key in path[:-1]:
+        stream.expect('{')
+        while True:
+            if stream.peek() == '}':
+                return
+            name = stream.value()
+            stream.expect(':')
+            if name == key:
+                break
+            stream.value()
+            if stream.expect(',}') == '}':
+                return
+
+    if stream.peek() != '[':
+        return
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(',]') == ']':
+            return
+
+
+def _local_name(tag):
+    # '{namespace}row' -> 'row'
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_xml_items(fileobj, tag):
+    """
+    Yield every ``tag`` element of an XML stream as a xmltodict dict
+    (the element's content, same shape as in ``xmltodict.parse``).
+    Parsed elements are dropped from the tree right away.
+    """
+    stack = []
+    for event, elem in ET.iterparse(fileobj, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if _local_name(elem.tag) != tag:
+            continue
+        item = xmltodict.parse(ET.tostring(elem))
+        yield next(iter(item.values()))
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
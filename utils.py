@@ -5,10 +5,10 @@
 """
 import json
 import datetime
-from datetime import datetime
 
 
 # json.dumps(data, cls=JsonExtendEncoder)
+# large payloads: prefer serializer.dumps / serializer.dump
 class JsonExtendEncoder(json.JSONEncoder):
     """
         This class provide an extension to json serialization for datetime/date.
@@ -22,4 +22,4 @@ class JsonExtendEncoder(json.JSONEncoder):
         elif isinstance(o, datetime.date):
             return o.strftime('%Y-%m-%d')
         else:
-            return json.JSONEncoder.default(self, o)
\ No newline at end of file
+            return json.JSONEncoder.default(self, o)